@@ -1,12 +1,182 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+# Simulator loop:
+# 1. agents move
+# 2. cellular automata is updated (ie. future states are computed)
+# 3. future states become current state
+# 4. go to 1
+
+# last update: 2026-01-22_17h20
+
 import random
 import math
-import pygame
 import numpy as np
-import pygame.surfarray as surfarray
 import time
+import json
+import os
+import sys
+import struct
+import zlib
+from collections import deque
+import atexit
+import queue
+import socket
+import subprocess
+import threading
+import tracemalloc
+import multiprocessing as mp
+import multiprocessing.connection
+from multiprocessing import shared_memory
+from types import SimpleNamespace
+
+try:
+    from numba import _helperlib as numba_helperlib
+    from numba import njit, prange, typeof as numba_typeof, config as numba_config
+    def get_num_threads():
+        return numba_config.NUMBA_NUM_THREADS # numba.get_num_threads() starts the thread pool: forked workers would hang
+except ImportError:
+    print ("[WARNING] Numba not available.")
+    numba_helperlib = None
+    numba_typeof = None
+    prange = range
+    def njit(*args, **kwargs):
+        def wrapper(f):
+            return f
+        return wrapper
+    def get_num_threads():
+        return 1
+
+pygame = None # imported on first use: headless runs never load it
+
+def load_pygame():
+    global pygame
+    if pygame is None:
+        import pygame
+        import pygame.surfarray
+    return pygame
+
+# window title (no-op in headless runs)
+def set_caption(text: str) -> None:
+    if pygame is not None and pygame.display.get_init() and pygame.display.get_surface() is not None:
+        pygame.display.set_caption(text)
+
+# template class for agents
+
+class Agent:
+    _next_id = 0  # class-level counter
+    def __init__(self, x: float, y: float, type: str, params):
+        self.params = params
+        self.x = x
+        self.y = y
+        self.id = Agent._next_id
+        self.type = type
+        self.running = True
+        self.dx = params["dx"]
+        self.dy = params["dy"]
+        Agent._next_id += 1
+    def move(self, grid, agents):
+        pass
+    
+# =-=-= synchronous agent update (opt-in, run(..., agent_update=SynchronousUpdate()))
+
+# claim keys: each key is granted to at most one proposal per step
+def cell_claim(x: int, y: int) -> tuple:
+    return ("cell", int(x), int(y))
+
+def agent_claim(agent) -> tuple:
+    return ("agent", agent.id)
+
+# action proposed by an agent: the keys it needs exclusively, plus any fields read back by its apply()
+class Proposal(SimpleNamespace):
+    def __init__(self, *claims, **fields):
+        super().__init__(claims=claims, **fields)
+
+# splitmix64 finalizer on uint64 arrays
+def mix64(z: np.ndarray) -> np.ndarray:
+    with np.errstate(over="ignore"):
+        z = z + np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+# replaces the sequential `a.move(grid, agents)` loop, where every move sees the previous ones
+# and the outcome depends on list order. Each step:
+#   0. prepare(grid, agents), if given, computes what proposals share (e.g. population counts)
+#   1. propose: every running agent calls propose(grid, agents, rng, cells) on the same snapshot and
+#      returns a Proposal or None (nothing to do); it must not write anything. cells maps (x, y) to the
+#      running agents there, rng is a random.Random seeded from (seed, step, agent.id)
+#   2. resolve: proposals are ranked by a priority hashed from (seed, step, agent.id), a proposal is
+#      granted when none of its claims is held by a higher ranked one
+#   3. apply: apply(proposal, grid, agents, granted) in priority order (losers get granted=False), skipped
+#      for agents stopped by a previous apply (e.g. eaten); it may return a list of new agents.
+#      Stopped agents are then removed and new ones appended.
+# The result only depends on the seed, the step and the agent ids (run() stores the seed in
+# params["agent_update_seed"], so resumed runs continue with it). Since propose only reads, workers > 1
+# computes the proposals in chunks on a thread pool (pays off when propose calls nogil numba kernels).
+class SynchronousUpdate:
+    def __init__(self, seed: int = None, workers: int = 1, prepare=None):
+        self.seed = seed
+        self.workers = workers
+        self.prepare = prepare
+        self.pool = None
+        self.granted = 0 # last step
+        self.rejected = 0
+
+    def propose(self, grid, agents, seeds, cells, lo, hi):
+        return [agents[i].propose(grid, agents, random.Random(int(seeds[i])), cells) for i in range(lo, hi)]
+
+    def step(self, grid, agents, step: int):
+        if self.seed is None:
+            self.seed = random.getrandbits(64) # follows random.seed(), drawn after init_simulation
+        agents[:] = [a for a in agents if a.running]
+        n = len(agents)
+        if n == 0:
+            return
+        if self.prepare is not None:
+            self.prepare(grid, agents)
+        cells = {}
+        for a in agents:
+            cells.setdefault((a.x, a.y), []).append(a)
+        ids = np.fromiter((a.id for a in agents), dtype=np.uint64, count=n)
+        keys = mix64(mix64(np.full(n, self.seed, dtype=np.uint64) ^ np.uint64(step)) ^ ids)
+        seeds = mix64(keys ^ np.uint64(0xD1B54A32D192ED03))
+
+        if self.workers > 1 and n >= 2 * self.workers:
+            if self.pool is None:
+                from concurrent.futures import ThreadPoolExecutor
+                self.pool = ThreadPoolExecutor(self.workers)
+            bounds = np.linspace(0, n, self.workers + 1).astype(int)
+            chunks = [self.pool.submit(self.propose, grid, agents, seeds, cells, bounds[k], bounds[k + 1])
+                      for k in range(self.workers)]
+            proposals = [p for c in chunks for p in c.result()]
+        else:
+            proposals = self.propose(grid, agents, seeds, cells, 0, n)
+
+        order = np.argsort(keys, kind="stable")
+        held = set()
+        granted = np.zeros(n, dtype=bool)
+        for i in order:
+            p = proposals[i]
+            if p is not None and held.isdisjoint(p.claims):
+                held.update(p.claims)
+                granted[i] = True
+
+        born = []
+        for i in order:
+            a = agents[i]
+            if proposals[i] is not None and a.running:
+                new = a.apply(proposals[i], grid, agents, bool(granted[i]))
+                if new:
+                    born.extend(new)
+        self.granted = int(granted.sum())
+        self.rejected = sum(p is not None for p in proposals) - self.granted
+        agents[:] = [a for a in agents if a.running] + born
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
 
 # build lookup table for color (faster)
 def build_color_lut(colors: dict) -> np.ndarray:
@@ -15,20 +185,53 @@ def build_color_lut(colors: dict) -> np.ndarray:
         lut[k] = v
     return lut
 
+# averaged colours for zoomed-out rendering (level k: 2^k x 2^k cells per texel), computed each frame for
+# the visible region only: no copy of the grid is kept, the cost is one read of the visible cells
+# (HashLife views and memory-mapped grids only materialize those) and the memory is that of the window
+class ColorPyramid:
+    def __init__(self, lut: np.ndarray, shape, n_levels: int):
+        self.lut = lut.astype(np.float32)
+        self.n_levels = n_levels
+
+    # enough levels for the coarsest one to fit in the window
+    @staticmethod
+    def levels_for(dx: int, dy: int, win_w: int, win_h: int) -> int:
+        ratio = max(dx / win_w, dy / win_h)
+        return max(0, int(math.ceil(math.log2(ratio)))) if ratio > 1 else 0
+
+    # colours of the level k texels covering grid[ix0:ix1, iy0:iy1] (aligned on 2^k cells, so that
+    # texels do not shimmer while panning), as a (w, h, 3) uint8 array
+    def region(self, grid, k: int, ix0: int, ix1: int, iy0: int, iy1: int) -> np.ndarray:
+        x0, y0 = ix0 >> k << k, iy0 >> k << k
+        sub = np.asarray(grid[x0:min(grid.shape[0], -(-ix1 >> k) << k), y0:min(grid.shape[1], -(-iy1 >> k) << k)])
+        out = np.empty((-(-sub.shape[0] >> k), -(-sub.shape[1] >> k), 3), dtype=np.uint8)
+        average_colors(sub, self.lut, k, out)
+        return out
+
+# mean colour of each 2^k x 2^k block of cells (blocks cut by the edge average the cells they have)
+@njit(parallel=True, cache=True)
+def average_colors(sub, lut, k, out):
+    nx, ny = sub.shape
+    for i in prange(out.shape[0]):
+        for j in range(out.shape[1]):
+            r = 0.0
+            g = 0.0
+            b = 0.0
+            for x in range(i << k, min(nx, (i + 1) << k)):
+                for y in range(j << k, min(ny, (j + 1) << k)):
+                    c = sub[x, y]
+                    r += lut[c, 0]
+                    g += lut[c, 1]
+                    b += lut[c, 2]
+            n = (min(nx, (i + 1) << k) - (i << k)) * (min(ny, (j + 1) << k) - (j << k))
+            out[i, j, 0] = int(r / n)
+            out[i, j, 1] = int(g / n)
+            out[i, j, 2] = int(b / n)
+
 # render CA and agents (if any)
-def draw_grid(
-    screen: pygame.Surface,
-    grid,
-    dx: int,
-    dy: int,
-    win_w: int,
-    win_h: int,
-    zoom: float,
-    cx: float,
-    cy: float,
-    agents,
-    color_lut: np.ndarray,
-) -> None:
+# layout of the grid in the window: cell size, top-left corner (cells), visible cells [ix0:ix1, iy0:iy1]
+# and pixel offset (grid centered when it fits)
+def grid_view(dx, dy, win_w, win_h, zoom, cx, cy):
     base_cell_size = min(win_w / dx, win_h / dy)
     cell_size = base_cell_size * zoom
 
@@ -62,19 +265,43 @@ def draw_grid(
         off_x = 0
         off_y = 0
 
-    sub = grid[ix0:ix1, iy0:iy1]
+    return cell_size, x0, y0, ix0, iy0, ix1, iy1, off_x, off_y
+
+def draw_grid(
+    screen: "pygame.Surface",
+    grid,
+    dx: int,
+    dy: int,
+    win_w: int,
+    win_h: int,
+    zoom: float,
+    cx: float,
+    cy: float,
+    agents,
+    color_ca_lut: np.ndarray,
+    color_agents_lut: np.ndarray,
+    pyramid: ColorPyramid = None,
+) -> None:
+    load_pygame()
+
+    cell_size, x0, y0, ix0, iy0, ix1, iy1, off_x, off_y = grid_view(dx, dy, win_w, win_h, zoom, cx, cy)
+
     w_px = max(1, int((ix1 - ix0) * cell_size))
     h_px = max(1, int((iy1 - iy0) * cell_size))
 
-    if cell_size < 1.0:
+    k = 0
+    if cell_size < 1.0 and pyramid is not None:
+        k = min(pyramid.n_levels, int(math.floor(math.log2(1.0 / cell_size))))
+
+    if k > 0:
+        rgb = pyramid.region(grid, k, ix0, ix1, iy0, iy1)
+    elif cell_size < 1.0:
         sx = max(1, int(round((ix1 - ix0) / w_px)))
         sy = max(1, int(round((iy1 - iy0) / h_px)))
-        sub_small = sub[::sx, ::sy]
+        rgb = color_ca_lut[grid[ix0:ix1:sx, iy0:iy1:sy]]
     else:
-        sub_small = sub
-
-    rgb = color_lut[sub_small]
-    surf = surfarray.make_surface(rgb)
+        rgb = color_ca_lut[grid[ix0:ix1, iy0:iy1]]
+    surf = pygame.surfarray.make_surface(rgb)
 
     if surf.get_width() != w_px or surf.get_height() != h_px:
         surf = pygame.transform.scale(surf, (w_px, h_px))
@@ -84,13 +311,15 @@ def draw_grid(
     r = max(1, int(cell_size / 2))
 
     for a in agents:
+        if not a.running:
+            continue
         ax, ay = a.x, a.y
         if not (0 <= ax < dx and 0 <= ay < dy):
             continue
         px = off_x + int((ax - x0) * cell_size + cell_size / 2)
         py = off_y + int((ay - y0) * cell_size + cell_size / 2)
         if 0 <= px < win_w and 0 <= py < win_h:
-            pygame.draw.circle(screen, (255, 128, 0), (px, py), r)
+            pygame.draw.circle(screen, tuple(color_agents_lut[a.type]), (px, py), r)
 
 # manage zoom when rendering
 def clamp_camera(cx, cy, dx, dy, win_w, win_h, zoom):
@@ -108,151 +337,2081 @@ def clamp_camera(cx, cy, dx, dy, win_w, win_h, zoom):
     cy = max(half_h, min(cy, dy - half_h))
     return cx, cy
 
+# camera keys shared by run and replay: z/shift+z zoom, r resets the view, arrows move
+def camera_key(key, shift, zoom, cx, cy, dx, dy, move_span_init):
+    move_span = move_span_init / zoom
+    if key == pygame.K_z:
+        zoom = zoom * 1.1 if shift else zoom / 1.1
+        if zoom < 1.0:
+            zoom = 1.0
+    elif key == pygame.K_r and not shift:
+        zoom = 1.0
+        cx, cy = (dx - 1) / 2.0, (dy - 1) / 2.0
+    elif key == pygame.K_LEFT:
+        cx = max(0, cx - move_span)
+    elif key == pygame.K_RIGHT:
+        cx = min(dx - 1, cx + move_span)
+    elif key == pygame.K_UP:
+        cy = max(0, cy - move_span)
+    elif key == pygame.K_DOWN:
+        cy = min(dy - 1, cy + move_span)
+    return zoom, cx, cy
+
+# continuous camera move while shift is held
+def camera_held(zoom, cx, cy, dx, dy, move_span_init):
+    move_span = move_span_init / zoom
+    keys = pygame.key.get_pressed()
+    shift_held = bool(pygame.key.get_mods() & pygame.KMOD_SHIFT)
+    if shift_held:
+        if keys[pygame.K_LEFT]:
+            cx = max(0, cx - move_span)
+        if keys[pygame.K_RIGHT]:
+            cx = min(dx - 1, cx + move_span)
+        if keys[pygame.K_UP]:
+            cy = max(0, cy - move_span)
+        if keys[pygame.K_DOWN]:
+            cy = min(dy - 1, cy + move_span)
+    return cx, cy
+
+# =-=-= parallel row blocks
+
+# one random stream per row block: results only depend on the number of blocks, not on thread scheduling
+def make_block_rngs(n_blocks: int = 0, seed: int = None) -> np.ndarray:
+    if n_blocks <= 0:
+        n_blocks = get_num_threads()
+    if seed is None:
+        seed = random.getrandbits(64) # follows random.seed() and checkpoints
+    return np.random.SeedSequence(seed).generate_state(n_blocks, dtype=np.uint64)
+
+# splitmix64 step for block b, returns a float in [0, 1)
+@njit(cache=True)
+def block_random(states, b):
+    z = states[b] + np.uint64(0x9E3779B97F4A7C15)
+    states[b] = z
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z = z ^ (z >> np.uint64(31))
+    return (z >> np.uint64(11)) * (1.0 / 9007199254740992.0)
+
+# first and last+1 row of block b when n rows are split in n_blocks
+@njit(cache=True)
+def block_rows(n, b, n_blocks):
+    return b * n // n_blocks, (b + 1) * n // n_blocks
+
+# =-=-= observables
+
+# named per-step metrics, evaluated together every `every` steps and stored in one table keyed by step
+# (and replica, for (K, dx, dy) ensemble grids, see run_ensemble):
+# grid state counts share one np.bincount, agent type counts share one pass over the agents,
+# custom callables f(grid, agents, values) can reuse the values computed before them.
+# path: ".csv" (streamed, "# step,..." header line) or ".npz" (one array per column, written at close)
+class Observables:
+    def __init__(self, path: str = None, every: int = 1, flush_every: int = 100):
+        self.path = path
+        self.every = every
+        self.flush_every = flush_every
+        self.columns = []
+        self.states = {}
+        self.types = {}
+        self.running_only = True
+        self.custom = {}
+        self.last = {}
+        self.rows = [] # not yet written (csv) or whole table (npz)
+        self.header_written = False
+        self.keys = ["step"]
+
+    def grid_states(self, states: dict) -> None: # name -> cell state
+        self.states.update(states)
+        self.columns += list(states)
+
+    def agent_types(self, types: dict, running_only: bool = True) -> None: # name -> agent type
+        self.types.update(types)
+        self.running_only = running_only
+        self.columns += list(types)
+
+    def add(self, name: str, f) -> None:
+        self.custom[name] = f
+        self.columns.append(name)
+
+    def sample(self, step: int, grid, agents) -> dict:
+        values = {}
+        if self.states and grid.ndim == 3: # ensemble: one count per replica
+            m = max(self.states.values()) + 1
+            hist = np.stack([np.bincount(g.reshape(-1), minlength=m)[:m] for g in grid])
+            for name, state in self.states.items():
+                values[name] = hist[:, state]
+        elif self.states:
+            hist = np.bincount(np.asarray(grid).reshape(-1), minlength=max(self.states.values()) + 1)
+            for name, state in self.states.items():
+                values[name] = int(hist[state])
+        if self.types:
+            counts = {}
+            for a in agents:
+                if a.running or not self.running_only:
+                    counts[a.type] = counts.get(a.type, 0) + 1
+            for name, t in self.types.items():
+                values[name] = counts.get(t, 0)
+        for name, f in self.custom.items():
+            values[name] = f(grid, agents, values)
+        self.last = values
+        if self.path is not None and grid.ndim == 3:
+            n = grid.shape[0]
+            self.keys = ["step", "replica"]
+            self.rows += np.column_stack([np.full(n, step), np.arange(n)] + [np.broadcast_to(values[c], (n,)) for c in self.columns]).tolist()
+            if len(self.rows) >= self.flush_every and not self.path.endswith(".npz"):
+                self.flush()
+        elif self.path is not None:
+            self.rows.append([step] + [values[c] for c in self.columns])
+            if len(self.rows) >= self.flush_every and not self.path.endswith(".npz"):
+                self.flush()
+        return values
+
+    # continue the table of a run resumed at `step` (run(resume_from=...) calls it): the rows already
+    # written up to that step are kept (later ones are dropped) and the new rows are appended
+    def resume(self, step: int) -> None:
+        self.rows = []
+        if self.path is None or not os.path.exists(self.path):
+            return
+        if self.path.endswith(".npz"):
+            with np.load(self.path) as data:
+                self.keys = ["step", "replica"] if "replica" in data.files else ["step"]
+                table = np.column_stack([data[c].astype(np.float64) for c in self.keys + self.columns])
+            self.rows = table[table[:, 0] <= step].tolist()
+            return
+        with open(self.path) as f:
+            lines = f.readlines()
+        if not lines or not lines[0].startswith("# "):
+            return
+        self.keys = ["step", "replica"] if lines[0][2:].split(",")[1] == "replica" else ["step"]
+        with open(self.path, "w") as f:
+            f.write(lines[0])
+            f.writelines(line for line in lines[1:] if line.strip() and float(line.split(",", 1)[0]) <= step)
+        self.header_written = True
+
+    def flush(self) -> None:
+        if self.path is None or not self.rows or self.path.endswith(".npz"):
+            return
+        with open(self.path, "a" if self.header_written else "w") as f:
+            if not self.header_written:
+                f.write("# " + ",".join(self.keys + self.columns) + "\n")
+                self.header_written = True
+            np.savetxt(f, np.array(self.rows, dtype=np.float64), delimiter=",", fmt="%.10g")
+        self.rows = []
+
+    def close(self) -> None:
+        if self.path is not None and self.path.endswith(".npz"):
+            k = len(self.keys)
+            table = np.array(self.rows, dtype=np.float64).reshape(-1, len(self.columns) + k)
+            np.savez(self.path, **{c: table[:, i].astype(np.int64) for i, c in enumerate(self.keys)},
+                     **{c: table[:, i + k] for i, c in enumerate(self.columns)})
+        else:
+            self.flush()
+
+# =-=-= early termination
+
+# stops a run when a predicate on the observables holds (name -> callable(values) -> bool), or when
+# the world state repeats: every `every` steps a 64-bit hash of the grid and of the agents (x, y, type)
+# is compared with the last `max_period` ones. A repeat is only a true cycle for deterministic rules.
+# action "fast_forward" (runs with max_simulation_steps) skips the remaining whole cycles instead of stopping.
+class Termination:
+    def __init__(self, predicates: dict = None, detect_cycles: bool = False, max_period: int = 100, every: int = 1, action: str = "stop"):
+        self.predicates = predicates or {}
+        self.detect_cycles = detect_cycles
+        self.every = every
+        self.action = action
+        self.history = deque(maxlen=max_period)
+        self.seen = {}
+        self.reason = None
+        self.step = None
+        self.period = None
+
+    @staticmethod
+    def state_hash(grid, agents) -> int:
+        positions = np.array([(a.x, a.y, a.type) for a in agents if a.running], dtype=np.int64)
+        return (zlib.crc32(np.ascontiguousarray(grid)) << 32) | zlib.crc32(positions)
+
+    # returns the reason to stop (or None)
+    def check(self, step: int, grid, agents, values: dict):
+        for name, f in self.predicates.items():
+            if f(values):
+                self.reason, self.step = name, step
+                return name
+        if self.detect_cycles and step % self.every == 0:
+            h = self.state_hash(grid, agents)
+            if h in self.seen:
+                self.period = step - self.seen[h]
+                self.reason = "fixed point" if self.period == 1 else "cycle of period " + str(self.period)
+                self.step = step
+                return self.reason
+            if len(self.history) == self.history.maxlen:
+                del self.seen[self.history[0]]
+            self.history.append(h)
+            self.seen[h] = step
+        return None
+
+# =-=-= live charts
+
+# fixed-size history of one metric (oldest values are overwritten)
+class RingBuffer:
+    def __init__(self, capacity: int):
+        self.data = np.zeros(capacity)
+        self.index = 0
+        self.count = 0
+
+    def append(self, value) -> None:
+        self.data[self.index] = value
+        self.index = (self.index + 1) % len(self.data)
+        self.count = min(self.count + 1, len(self.data))
+
+    # values in chronological order
+    def values(self) -> np.ndarray:
+        if self.count < len(self.data):
+            return self.data[:self.count]
+        return np.concatenate((self.data[self.index:], self.data[:self.index]))
+
+# strip chart panel drawn over the grid ("c" key): metrics are sampled every step,
+# polylines are only computed at render frames
+class StripChart:
+    COLORS = [(200, 0, 0), (0, 0, 200), (0, 150, 0), (200, 120, 0), (120, 0, 160), (0, 140, 140)]
+
+    def __init__(self, metrics: dict, length: int = 500):
+        self.metrics = {} # name -> callable(grid, agents)
+        self.colors = {}
+        for k, (name, m) in enumerate(metrics.items()):
+            f, color = m if isinstance(m, tuple) else (m, self.COLORS[k % len(self.COLORS)])
+            self.metrics[name] = f
+            self.colors[name] = color
+        self.buffers = {name: RingBuffer(length) for name in metrics}
+        self.visible = True
+
+    def sample(self, grid, agents) -> None:
+        for name, f in self.metrics.items():
+            self.buffers[name].append(f(grid, agents))
+
+    def draw(self, screen, font, rect) -> None:
+        if not self.visible:
+            return
+        x0, y0, w, h = rect
+        panel = pygame.Surface((w, h), pygame.SRCALPHA)
+        panel.fill((255, 255, 255, 200))
+        screen.blit(panel, (x0, y0))
+        series = [(name, b.values()) for name, b in self.buffers.items()]
+        if not series or series[0][1].size < 2:
+            return
+        vmin = min(v.min() for _, v in series)
+        vmax = max(v.max() for _, v in series)
+        scale = (h - 10) / (vmax - vmin) if vmax > vmin else 0.0
+        capacity = len(self.buffers[series[0][0]].data)
+        for k, (name, v) in enumerate(series):
+            color = self.colors[name]
+            px = x0 + np.arange(v.size) * ((w - 1) / (capacity - 1))
+            py = y0 + h - 5 - (v - vmin) * scale
+            pygame.draw.lines(screen, color, False, np.column_stack((px, py)).tolist())
+            screen.blit(font.render(f"{name}: {v[-1]:g}", True, color), (x0 + 5, y0 + 5 + 18 * k))
+
+# =-=-= offscreen frame export
+
+# frames are drawn on a plain Surface (no display) and written by a background thread:
+# "frames/frame_%06d.png" writes numbered PNGs, any other path is encoded by ffmpeg (raw RGB on stdin)
+class FrameExporter:
+    def __init__(self, path: str, width: int, height: int, fps: int = 30, queue_size: int = 16):
+        self.path = path
+        self.surface = load_pygame().Surface((width, height))
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.encoder = None
+        if "%" not in path:
+            cmd = ["ffmpeg", "-loglevel", "error", "-y", "-f", "rawvideo", "-pix_fmt", "rgb24",
+                   "-s", f"{width}x{height}", "-r", str(fps), "-i", "-", "-pix_fmt", "yuv420p", path]
+            self.encoder = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        elif os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.count = 0
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def _writer(self) -> None:
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            index, rgb = item
+            if self.encoder is not None:
+                self.encoder.stdin.write(rgb.transpose(1, 0, 2).tobytes())
+            else:
+                pygame.image.save(pygame.surfarray.make_surface(rgb), self.path % index)
+
+    # draw a frame exactly like the window would (same draw_grid, zoom and camera) and queue it
+    def write(self, grid, dx, dy, zoom, cx, cy, agents, color_ca_lut, color_agents_lut, pyramid=None) -> None:
+        w, h = self.surface.get_size()
+        self.surface.fill((0, 0, 0))
+        draw_grid(self.surface, grid, dx, dy, w, h, zoom, cx, cy, agents, color_ca_lut, color_agents_lut, pyramid)
+        self.queue.put((self.count, pygame.surfarray.array3d(self.surface)))
+        self.count += 1
+
+    def close(self) -> None:
+        self.queue.put(None)
+        self.thread.join()
+        if self.encoder is not None:
+            self.encoder.stdin.close()
+            self.encoder.wait()
+
+# =-=-= step timings and metrics endpoint
+
+# wall time per phase of the step loop: mark(name) closes the phase opened by the previous mark
+class PhaseTimer:
+    def __init__(self):
+        self.totals = {}
+        self.last = time.perf_counter()
+
+    # start of the step loop (run() calls it after its setup, which is not attributed to any phase)
+    def begin(self) -> None:
+        self.last = time.perf_counter()
+
+    def mark(self, name: str) -> None:
+        now = time.perf_counter()
+        self.totals[name] = self.totals.get(name, 0.0) + now - self.last
+        self.last = now
+
+    def end_step(self, step: int) -> None:
+        pass
+
+    # mean milliseconds per step since the previous call
+    def collect(self, steps: int) -> dict:
+        means = {name: 1000.0 * t / max(1, steps) for name, t in self.totals.items()}
+        self.totals = {}
+        return means
+
+# allocation profile per phase (opt-in, tracemalloc slows python allocations down): for each phase, the mean
+# transient bytes (peak above the phase start) and retained bytes per step; every `every` steps a snapshot
+# diff also counts the retained blocks per phase. Traced memory sampled at those steps flags steady growth
+# (`growth_window` increasing samples in a row, e.g. agents never removed), with its main allocation sites.
+# Tracing starts after `warmup_steps` unprofiled steps, once the numba kernels are compiled or loaded from
+# the cache (otherwise their JIT allocations are charged to the phase that first calls them).
+# report() is text, to_dict() (or `path`, written by close()) is json for benchmarks.
+class AllocationProfiler(PhaseTimer):
+    def __init__(self, every: int = 100, growth_window: int = 10, top: int = 5, path: str = None, warmup_steps: int = 1):
+        super().__init__()
+        self.warmup_steps = warmup_steps
+        self.warming = warmup_steps
+        self.tracing = False
+        self.every = every
+        self.growth_window = growth_window
+        self.top = top
+        self.path = path
+        self.steps = 0
+        self.phases = {} # name -> [transient bytes, retained bytes, retained blocks (sampled), samples]
+        self.memory = [] # (step, traced bytes) every `every` steps
+        self.first = None
+        self.sites = []
+
+    def begin(self) -> None:
+        super().begin()
+        self.warming = self.warmup_steps
+        if self.warming <= 0:
+            self.start_tracing()
+
+    def start_tracing(self) -> None:
+        if not self.tracing:
+            tracemalloc.start()
+            self.tracing = True
+        self.snapshot = tracemalloc.take_snapshot()
+        self.start = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        self.last = time.perf_counter()
+
+    def mark(self, name: str) -> None:
+        super().mark(name)
+        if not self.tracing:
+            return
+        current, peak = tracemalloc.get_traced_memory()
+        stats = self.phases.setdefault(name, [0, 0, 0, 0])
+        stats[0] += peak - self.start
+        stats[1] += current - self.start
+        if self.steps % self.every == 0:
+            snapshot = tracemalloc.take_snapshot()
+            stats[2] += sum(d.count_diff for d in snapshot.compare_to(self.snapshot, "filename"))
+            stats[3] += 1
+            self.snapshot = snapshot
+        self.start = tracemalloc.get_traced_memory()[0] # snapshots allocate too
+        tracemalloc.reset_peak()
+        self.last = time.perf_counter()
+
+    def end_step(self, step: int) -> None:
+        if not self.tracing:
+            self.warming -= 1
+            if self.warming <= 0:
+                self.start_tracing()
+            return
+        if self.steps % self.every == 0:
+            self.memory.append((step, tracemalloc.get_traced_memory()[0]))
+            if self.first is None:
+                self.first = self.snapshot
+            elif self.growing():
+                self.sites = [str(d) for d in self.snapshot.compare_to(self.first, "lineno")[:self.top]]
+        self.steps += 1
+        if self.steps % self.every == 0: # baseline of the next sampled step
+            self.snapshot = tracemalloc.take_snapshot()
+            self.start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            self.last = time.perf_counter()
+
+    def growing(self) -> bool:
+        window = [m for _, m in self.memory[-self.growth_window - 1:]]
+        return len(window) > self.growth_window and all(b > a for a, b in zip(window, window[1:]))
+
+    def to_dict(self) -> dict:
+        steps = max(1, self.steps)
+        growth = None
+        if self.growing():
+            (s0, m0), (s1, m1) = self.memory[-self.growth_window - 1], self.memory[-1]
+            growth = {"bytes_per_step": (m1 - m0) / max(1, s1 - s0), "sites": self.sites}
+        return {
+            "steps": self.steps,
+            "phases": {name: {"transient_bytes_per_step": t / steps, "retained_bytes_per_step": r / steps,
+                              "retained_blocks_per_step": b / n if n else 0.0}
+                       for name, (t, r, b, n) in self.phases.items()},
+            "traced_bytes": self.memory[-1][1] if self.memory else 0,
+            "growth": growth,
+        }
+
+    def report(self) -> str:
+        d = self.to_dict()
+        lines = [f"allocations over {d['steps']} steps after {self.warmup_steps} warm-up step(s) "
+                 f"(per step: transient KiB, retained bytes, retained blocks)",
+                 f"  (every {self.every} steps, a snapshot per phase counts blocks: those steps run ~100x slower)"]
+        for name, p in d["phases"].items():
+            lines.append(f"  {name:10s} {p['transient_bytes_per_step'] / 1024:10.1f} {p['retained_bytes_per_step']:12.1f} {p['retained_blocks_per_step']:10.2f}")
+        if d["growth"] is not None:
+            lines.append(f"  [WARNING] steady memory growth: {d['growth']['bytes_per_step']:.0f} bytes/step, from:")
+            lines += ["    " + site for site in d["growth"]["sites"]]
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                json.dump(self.to_dict(), f, indent=1)
+        if self.tracing:
+            tracemalloc.stop()
+            self.tracing = False
+
+# resident memory of this process in bytes (-1 where /proc is not available)
+def memory_rss() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        return -1
+
+# live counters over HTTP on a background thread: GET /metrics (plain text, one "name value" per line)
+# or /metrics.json. update() replaces the whole snapshot (a single reference assignment) and requests
+# only read it, so the step loop never waits for a reader.
+class MetricsServer:
+    def __init__(self, port: int = 8000, host: str = "127.0.0.1"):
+        import http.server
+
+        self.snapshot = {}
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                snapshot = server.snapshot
+                if self.path == "/metrics.json":
+                    body, kind = json.dumps(snapshot, default=float).encode(), "application/json"
+                elif self.path in ("/", "/metrics"):
+                    body, kind = server.text(snapshot).encode(), "text/plain; charset=utf-8"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", kind)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def update(self, **values) -> None:
+        self.snapshot = values
+
+    # nested dicts are flattened: {"phase_ms": {"ca_step": 1.5}} -> "phase_ms_ca_step 1.5"
+    @staticmethod
+    def text(snapshot: dict, prefix: str = "") -> str:
+        lines = []
+        for name, value in snapshot.items():
+            if isinstance(value, dict):
+                lines.append(MetricsServer.text(value, prefix + name + "_").rstrip("\n"))
+            elif isinstance(value, (float, np.floating)):
+                lines.append(f"{prefix}{name} {float(value)!r}")
+            else:
+                lines.append(f"{prefix}{name} {value}")
+        return "\n".join(line for line in lines if line) + "\n"
+
+    def close(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+# =-=-= stochastic cell events
+
+# numpy generator seeded from python's random (follows random.seed() and checkpoints)
+def make_rng(seed: int = None) -> np.random.Generator:
+    return np.random.default_rng(random.getrandbits(64) if seed is None else seed)
+
+# per-step Bernoulli masks for named event probabilities, from a single vectorized draw
+# (buffers are allocated once per grid shape)
+class RandomEvents:
+    def __init__(self):
+        self.uniforms = None
+        self.masks = None
+
+    def draw(self, rng: np.random.Generator, shape, probabilities: dict) -> dict:
+        n = len(probabilities)
+        if self.uniforms is None or self.uniforms.shape != (n,) + tuple(shape):
+            self.uniforms = np.empty((n,) + tuple(shape), dtype=np.float32)
+            self.masks = np.empty((n,) + tuple(shape), dtype=bool)
+        rng.random(dtype=np.float32, out=self.uniforms)
+        p = np.array(list(probabilities.values()), dtype=np.float32).reshape((n,) + (1,) * len(shape))
+        np.less(self.uniforms, p, out=self.masks)
+        return {name: self.masks[k] for k, name in enumerate(probabilities)}
+
+    # rare-event mode: flat indices of the cells in `state` that fire an event of probability p.
+    # Same distribution as one coin flip per eligible cell: the number of events is binomial,
+    # then the cells are picked uniformly (rejection sampling, cost ~ number of events).
+    # n_eligible, the number of cells in `state`, is required: counting it here would scan the
+    # whole grid on every call. Take it from a pass the step already makes (RuleKernel.counts)
+    # and keep it up to date between calls (minus the cells an event just changed).
+    @staticmethod
+    def sample_cells(rng: np.random.Generator, grid, state, p: float, n_eligible: int) -> np.ndarray:
+        flat = grid.reshape(-1)
+        k = rng.binomial(n_eligible, p)
+        if k == 0:
+            return np.zeros(0, dtype=np.int64)
+        if n_eligible < 4 * k or 8 * n_eligible < flat.size: # many events or few eligible cells: enumerate
+            return rng.choice(np.flatnonzero(flat == state), k, replace=False)
+        chosen = np.zeros(0, dtype=np.int64)
+        while chosen.size < k:
+            candidates = rng.integers(0, flat.size, int((k - chosen.size) * flat.size / n_eligible * 1.5) + 8)
+            chosen = np.concatenate((chosen, candidates[flat[candidates] == state]))
+            _, first = np.unique(chosen, return_index=True)
+            chosen = chosen[np.sort(first)] # drop duplicates, keep the random order
+        return chosen[:k]
+
+# =-=-= neighbourhoods and rule tables (declarative transitions compiled to a lookup table)
+
+# (dx, dy) offsets of a Moore or von Neumann neighbourhood of radius r (center excluded)
+def neighbourhood_offsets(neighbourhood: str = "moore", radius: int = 1) -> np.ndarray:
+    if neighbourhood not in ("moore", "von_neumann"):
+        raise ValueError(f"unknown neighbourhood: {neighbourhood}")
+    offsets = [(i, j) for i in range(-radius, radius + 1) for j in range(-radius, radius + 1)
+               if (i, j) != (0, 0) and (neighbourhood == "moore" or abs(i) + abs(j) <= radius)]
+    return np.array(offsets, dtype=np.int64)
+
+neighbour_offsets_cache = {} # (neighbourhood, radius) -> offsets
+neighbour_states_cache = {} # states -> state index table (grown when larger states show up)
+
+# per-cell neighbour counts of the given states, out[k, x, y] = number of neighbours of (x, y) in states[k]
+# (toroidal, one compiled pass). Pass the previous result as `out` to reuse its buffer every step.
+def neighbour_counts(grid, states, neighbourhood: str = "moore", radius: int = 1, out: np.ndarray = None) -> np.ndarray:
+    offsets = neighbour_offsets_cache.get((neighbourhood, radius))
+    if offsets is None:
+        offsets = neighbour_offsets_cache[(neighbourhood, radius)] = neighbourhood_offsets(neighbourhood, radius)
+    shape = (len(states),) + grid.shape
+    if out is None or out.shape != shape:
+        out = np.empty(shape, dtype=np.uint8 if len(offsets) < 256 else np.uint16)
+    states = tuple(states)
+    size = max(max(states, default=-1), 255 if grid.itemsize == 1 else 65535 if grid.itemsize == 2 else int(grid.max())) + 1
+    state_index = neighbour_states_cache.get(states)
+    if state_index is None or state_index.size < size:
+        state_index = neighbour_states_cache[states] = np.full(size, -1, dtype=np.int64)
+        state_index[list(states)] = np.arange(len(states))
+    neighbour_counts_kernel(grid, state_index, offsets, out)
+    return out
+
+@njit(parallel=True, cache=True)
+def neighbour_counts_kernel(grid, state_index, offsets, out):
+    dx, dy = grid.shape
+    for x in prange(dx):
+        for y in range(dy):
+            for k in range(out.shape[0]):
+                out[k, x, y] = 0
+            for o in range(offsets.shape[0]):
+                i = state_index[grid[(x + offsets[o, 0]) % dx, (y + offsets[o, 1]) % dy]]
+                if i >= 0:
+                    out[i, x, y] += 1
+
+# grids carrying an r-cell halo (ghost cells) refilled once per step by a boundary mode, so that
+# kernels read neighbours at [x + r + i, y + r + j] without modulo. run(), draw_grid and user code
+# get the interior views (no copy); kernels get the padded buffer from refresh():
+#   halo = Halo(1, "fixed", fill=EMPTY)
+#   grid, newgrid = halo.zeros((dx, dy), np.uint8), halo.empty((dx, dy), np.uint8) # in init_simulation
+#   kernel(halo.refresh(grid), newgrid) # in ca_step
+class Halo:
+    MODES = ("periodic", "fixed", "reflective")
+
+    def __init__(self, radius: int = 1, mode: str = "periodic", fill: int = 0):
+        if mode not in self.MODES:
+            raise ValueError(f"unknown boundary mode: {mode} (expected one of {self.MODES})")
+        self.radius = radius
+        self.mode = mode
+        self.fill = fill
+        self.scratch = None
+
+    def empty(self, shape, dtype) -> np.ndarray:
+        r = self.radius
+        padded = np.full((shape[0] + 2 * r, shape[1] + 2 * r), self.fill, dtype=dtype)
+        return padded[r:-r, r:-r]
+
+    def zeros(self, shape, dtype) -> np.ndarray:
+        interior = self.empty(shape, dtype)
+        interior[:] = 0
+        return interior
+
+    # padded buffer of an interior view (grids from load_checkpoint are copied into a scratch buffer)
+    def padded(self, interior) -> np.ndarray:
+        r = self.radius
+        base = interior.base
+        if (base is not None and base.shape == (interior.shape[0] + 2 * r, interior.shape[1] + 2 * r)
+                and base[r:-r, r:-r].ctypes.data == interior.ctypes.data):
+            return base
+        if self.scratch is None or self.scratch.shape[0] - 2 * r != interior.shape[0] or self.scratch.shape[1] - 2 * r != interior.shape[1]:
+            self.scratch = np.full((interior.shape[0] + 2 * r, interior.shape[1] + 2 * r), self.fill, dtype=interior.dtype)
+        self.scratch[r:-r, r:-r] = interior
+        return self.scratch
+
+    # fill the halo from the interior, returns the padded buffer
+    def refresh(self, interior) -> np.ndarray:
+        p = self.padded(interior)
+        r = self.radius
+        dx, dy = interior.shape
+        if self.mode == "periodic":
+            p[:r, r:-r] = p[dx:dx + r, r:-r]
+            p[-r:, r:-r] = p[r:2 * r, r:-r]
+            p[:, :r] = p[:, dy:dy + r]
+            p[:, -r:] = p[:, r:2 * r]
+        elif self.mode == "reflective": # mirrored edge cells (zero flux)
+            p[:r, r:-r] = p[r:2 * r, r:-r][::-1]
+            p[-r:, r:-r] = p[dx:dx + r, r:-r][::-1]
+            p[:, :r] = p[:, r:2 * r][:, ::-1]
+            p[:, -r:] = p[:, dy:dy + r][:, ::-1]
+        # fixed: the halo keeps the fill state it was allocated with
+        return p
+
+# transitions (state, number of neighbours in each counted state) -> next state, e.g. forest fire:
+#   rules = RuleTable(4)
+#   rules.add(ASH, EMPTY)
+#   rules.add(FIRE, ASH)
+#   rules.add(TREE, FIRE, when={FIRE: range(1, 9)})
+#   rules.add(TREE, FIRE, probability=P_fire) # spontaneous, otherwise the next matching rule
+#   ca_step = rules.compile()
+# the first matching rule wins (like an if/elif chain), cells without a matching rule keep their state.
+# probabilistic rules chain the same way: add(EMPTY, TREE, probability=p1); add(EMPTY, FIRE, probability=p2)
+# gives TREE with p1, else FIRE with p2 (overall (1 - p1) * p2), else the next matching rule.
+class RuleTable:
+    def __init__(self, n_states: int, neighbourhood: str = "moore", radius: int = 1):
+        self.n_states = n_states
+        self.offsets = neighbourhood_offsets(neighbourhood, radius)
+        self.rules = []
+
+    # when: {neighbour state: count, iterable of counts or callable(count) -> bool}
+    def add(self, state: int, next_state: int, when: dict = None, probability: float = None) -> None:
+        self.rules.append((state, next_state, when or {}, probability))
+
+    def compile(self, n_blocks: int = 0, seed: int = None):
+        counted = sorted({s for _, _, when, _ in self.rules for s in when})
+        n = len(self.offsets) + 1 # possible counts: 0..len(offsets)
+        size = self.n_states * n ** len(counted)
+        if size > 1 << 24:
+            raise ValueError(f"rule table too large ({size} entries): count fewer states")
+        codes = np.arange(n ** len(counted))
+        counts = {s: codes // n ** k % n for k, s in enumerate(counted)}
+
+        # per (state, code): outcomes[k] is the k-th matching probabilistic rule, drawn when
+        # u < thresholds[k] (cumulative, one uniform u per cell), the last one the deterministic rule
+        k_max = max([sum(1 for r in self.rules if r[0] == s and r[3] is not None) for s in range(self.n_states)] + [1])
+        outcomes = np.repeat(np.arange(self.n_states, dtype=np.uint8)[:, None, None], codes.size, axis=1)
+        outcomes = np.repeat(outcomes, k_max + 1, axis=2)
+        thresholds = np.ones((self.n_states, codes.size, k_max))
+        n_random = np.zeros((self.n_states, codes.size), dtype=np.int64)
+        remaining = np.ones((self.n_states, codes.size)) # probability that no previous rule was drawn
+        done = np.zeros((self.n_states, codes.size), dtype=bool)
+        for state, next_state, when, p in self.rules:
+            match = np.ones(codes.size, dtype=bool)
+            for s, cond in when.items():
+                if callable(cond):
+                    match &= np.array([bool(cond(int(c))) for c in counts[s]])
+                elif np.isscalar(cond):
+                    match &= counts[s] == cond
+                else:
+                    match &= np.isin(counts[s], list(cond))
+            rows = np.flatnonzero(match & ~done[state])
+            k = n_random[state, rows]
+            outcomes[state, rows, k] = next_state
+            if p is None:
+                done[state, rows] = True
+            else:
+                thresholds[state, rows, k] = np.minimum(1.0, 1.0 - remaining[state, rows] * (1.0 - p))
+                remaining[state, rows] *= 1.0 - p
+                n_random[state, rows] += 1
+
+        state_index = np.full(256, -1, dtype=np.int64)
+        state_index[counted] = np.arange(len(counted))
+        return RuleKernel(outcomes, thresholds, state_index, self.offsets, n, make_block_rngs(n_blocks, seed))
+
+# compiled rule table: kernel(grid, newgrid) like any ca_step, random transitions draw from
+# one stream per row block (rng_blocks, see make_block_rngs). After each call, counts[s] is the
+# number of cells of newgrid in state s (counted in the same pass, e.g. for RandomEvents.sample_cells)
+class RuleKernel:
+    def __init__(self, outcomes, thresholds, state_index, offsets, n, rng_blocks):
+        self.outcomes = outcomes
+        self.thresholds = thresholds
+        self.state_index = state_index
+        self.offsets = offsets
+        self.n = n
+        self.rng_blocks = rng_blocks
+        self.random = bool(np.any(thresholds < 1))
+        self.block_counts = np.zeros((rng_blocks.shape[0], outcomes.shape[0]), dtype=np.int64)
+        self.counts = np.zeros(outcomes.shape[0], dtype=np.int64)
+
+    def __call__(self, grid, newgrid) -> None:
+        rule_table_step(grid, newgrid, self.outcomes, self.thresholds, self.state_index,
+                        self.offsets, self.n, self.random, self.rng_blocks, self.block_counts)
+        self.block_counts.sum(axis=0, out=self.counts)
+
+@njit(parallel=True, cache=True)
+def rule_table_step(grid, newgrid, outcomes, thresholds, state_index, offsets, n, random_, rng_blocks, block_counts):
+    dx, dy = grid.shape
+    n_blocks = rng_blocks.shape[0]
+    for b in prange(n_blocks):
+        x0, x1 = block_rows(dx, b, n_blocks)
+        block_counts[b, :] = 0
+        for x in range(x0, x1):
+            for y in range(dy):
+                code = 0
+                for k in range(offsets.shape[0]):
+                    i = state_index[grid[(x + offsets[k, 0]) % dx, (y + offsets[k, 1]) % dy]]
+                    if i >= 0:
+                        code += n ** i
+                state = grid[x, y]
+                k = 0
+                if random_ and thresholds[state, code, 0] < 1.0:
+                    u = block_random(rng_blocks, b)
+                    while k < thresholds.shape[2] and u >= thresholds[state, code, k]:
+                        k += 1
+                newgrid[x, y] = outcomes[state, code, k]
+                block_counts[b, newgrid[x, y]] += 1
+
+# =-=-= hashlife (memoized quadtree engine for deterministic rules)
+
+# quadtree node: level 1 holds 4 cell states, level k > 1 four level k-1 nodes
+# (q00: first half of both axes, q01: first half of axis 0 / second half of axis 1, ...)
+class Node:
+    __slots__ = ("level", "q00", "q01", "q10", "q11", "cache")
+
+    def __init__(self, level, q00, q01, q10, q11):
+        self.level = level
+        self.q00 = q00
+        self.q01 = q01
+        self.q10 = q10
+        self.q11 = q11
+        self.cache = {} # j -> center after 2^j steps
+
+# advances a toroidal 2^n x 2^n world by 2^k steps at once by caching the futures of identical
+# macro-cells. rule(grid, newgrid) is a deterministic step on a (toroidal) array, e.g. the
+# template's ca_step kernel without random events: it is only ever called on 4x4 blocks.
+# In run(), pass engine.init_simulation and engine.ca_step: each frame advances steps_per_frame steps
+# (a power of two is a single cached macro-step) and only the visible region is materialized.
+class HashLife:
+    def __init__(self, grid, rule, background: int = 0, max_nodes: int = 5000000, steps_per_frame: int = 1):
+        n = int(math.log2(grid.shape[0])) if grid.shape[0] > 0 else 0
+        if grid.shape[0] != grid.shape[1] or grid.shape[0] != 2 ** n or n < 2:
+            raise ValueError("HashLife needs a square grid whose size is a power of two (>= 4)")
+        self.rule = rule
+        self.dtype = grid.dtype
+        self.background = background
+        self.max_nodes = max_nodes
+        self.steps_per_frame = steps_per_frame
+        self.table = {}
+        self.empty = {}
+        self.shape = grid.shape
+        self.steps = 0
+        self.root = self.from_array(grid)
+        self.empty_node(self.root.level)
+
+    def join(self, q00, q01, q10, q11):
+        key = (q00, q01, q10, q11)
+        node = self.table.get(key)
+        if node is None:
+            level = 1 if not isinstance(q00, Node) else q00.level + 1
+            node = Node(level, q00, q01, q10, q11)
+            self.table[key] = node
+        return node
+
+    def empty_node(self, level):
+        if level not in self.empty:
+            if level == 1:
+                b = self.background
+                self.empty[level] = self.join(b, b, b, b)
+            else:
+                e = self.empty_node(level - 1)
+                self.empty[level] = self.join(e, e, e, e)
+        return self.empty[level]
+
+    # bottom-up build: only distinct blocks create nodes (quadrants paired as 1D keys for np.unique)
+    def from_array(self, grid):
+        ids = np.ascontiguousarray(grid).astype(np.int64)
+        nodes = None
+        while True:
+            q = (ids[0::2, 0::2].ravel(), ids[0::2, 1::2].ravel(), ids[1::2, 0::2].ravel(), ids[1::2, 1::2].ravel())
+            m = int(ids.max()) + 1
+            top, top_inv = np.unique(q[0] * m + q[1], return_inverse=True)
+            bottom, bottom_inv = np.unique(q[2] * m + q[3], return_inverse=True)
+            keys, inverse = np.unique(top_inv * len(bottom) + bottom_inv, return_inverse=True)
+            t, b = top[keys // len(bottom)], bottom[keys % len(bottom)]
+            quads = zip((t // m).tolist(), (t % m).tolist(), (b // m).tolist(), (b % m).tolist())
+            if nodes is None:
+                nodes = [self.join(*quad) for quad in quads]
+            else:
+                nodes = [self.join(nodes[i], nodes[j], nodes[k], nodes[l]) for i, j, k, l in quads]
+            ids = inverse.reshape(ids.shape[0] // 2, ids.shape[1] // 2)
+            if ids.shape == (1, 1):
+                return nodes[0]
+
+    # copy the cells of the region [x0:x1, y0:y1] (skips background macro-cells)
+    def to_array(self, x0: int = 0, x1: int = None, y0: int = 0, y1: int = None):
+        x1 = self.shape[0] if x1 is None else x1
+        y1 = self.shape[1] if y1 is None else y1
+        out = np.full((x1 - x0, y1 - y0), self.background, dtype=self.dtype)
+        self._fill(self.root, 0, 0, out, x0, x1, y0, y1)
+        return out
+
+    def _fill(self, node, nx, ny, out, x0, x1, y0, y1):
+        size = 2 ** node.level
+        if nx >= x1 or ny >= y1 or nx + size <= x0 or ny + size <= y0 or node is self.empty.get(node.level):
+            return
+        h = size // 2
+        if node.level == 1:
+            for (i, j), v in (((0, 0), node.q00), ((0, 1), node.q01), ((1, 0), node.q10), ((1, 1), node.q11)):
+                if x0 <= nx + i < x1 and y0 <= ny + j < y1:
+                    out[nx + i - x0, ny + j - y0] = v
+            return
+        self._fill(node.q00, nx, ny, out, x0, x1, y0, y1)
+        self._fill(node.q01, nx, ny + h, out, x0, x1, y0, y1)
+        self._fill(node.q10, nx + h, ny, out, x0, x1, y0, y1)
+        self._fill(node.q11, nx + h, ny + h, out, x0, x1, y0, y1)
+
+    def center(self, node):
+        return self.join(node.q00.q11, node.q01.q10, node.q10.q01, node.q11.q00)
+
+    # center (level - 1) of node after 2^j steps, j <= level - 2
+    def result(self, node, j):
+        r = node.cache.get(j)
+        if r is not None:
+            return r
+        if node.level == 2:
+            block = np.array([[node.q00.q00, node.q00.q01, node.q01.q00, node.q01.q01],
+                              [node.q00.q10, node.q00.q11, node.q01.q10, node.q01.q11],
+                              [node.q10.q00, node.q10.q01, node.q11.q00, node.q11.q01],
+                              [node.q10.q10, node.q10.q11, node.q11.q10, node.q11.q11]], dtype=self.dtype)
+            new = np.empty_like(block)
+            self.rule(block, new)
+            r = self.join(int(new[1, 1]), int(new[1, 2]), int(new[2, 1]), int(new[2, 2]))
+        else:
+            a, b, c, d = node.q00, node.q01, node.q10, node.q11
+            n = [[a, self.join(a.q01, b.q00, a.q11, b.q10), b],
+                 [self.join(a.q10, a.q11, c.q00, c.q01), self.join(a.q11, b.q10, c.q01, d.q00), self.join(b.q10, b.q11, d.q00, d.q01)],
+                 [c, self.join(c.q01, d.q00, c.q11, d.q10), d]]
+            if j == node.level - 2: # full speed: two half-steps
+                m = [[self.result(n[i][k], j - 1) for k in range(3)] for i in range(3)]
+                jj = j - 1
+            else: # slower: no time in the first phase
+                m = [[self.center(n[i][k]) for k in range(3)] for i in range(3)]
+                jj = j
+            r = self.join(self.result(self.join(m[0][0], m[0][1], m[1][0], m[1][1]), jj),
+                          self.result(self.join(m[0][1], m[0][2], m[1][1], m[1][2]), jj),
+                          self.result(self.join(m[1][0], m[1][1], m[2][0], m[2][1]), jj),
+                          self.result(self.join(m[1][1], m[1][2], m[2][1], m[2][2]), jj))
+        node.cache[j] = r
+        return r
+
+    # torus: the 2x2 tiling of the world evolves like the world itself, its center is the world
+    # shifted by half its size
+    def advance(self, steps: int) -> None:
+        n = self.root.level
+        while steps > 0:
+            j = min(n - 1, steps.bit_length() - 1)
+            w = self.root
+            r = self.result(self.join(w, w, w, w), j)
+            self.root = self.join(r.q11, r.q10, r.q01, r.q00)
+            steps -= 2 ** j
+            self.steps += 2 ** j
+            if len(self.table) > self.max_nodes: # forget shared nodes and futures (results stay correct)
+                self.table = {}
+                self.empty = {}
+                self.empty_node(n)
+
+    # run() compatible: both grids are the lazy view below, so a step only advances the quadtree
+    # (run's step counter counts frames: the engine is at self.steps)
+    def init_simulation(self, params):
+        return self.view(), self.view()
+
+    # run(resume_from=...): rebuild the quadtree from the checkpointed grid
+    def resume_simulation(self, params, grid, newgrid):
+        self.table = {}
+        self.empty = {}
+        self.root = self.from_array(np.asarray(grid, dtype=self.dtype))
+        self.empty_node(self.root.level)
+        return self.view(), self.view()
+
+    def ca_step(self, grid, newgrid) -> None:
+        if not isinstance(grid, HashLifeView) or grid.engine is not self:
+            raise ValueError("HashLife.ca_step needs the grids of engine.init_simulation "
+                             "(or engine.resume_simulation after a checkpoint)")
+        self.advance(self.steps_per_frame)
+
+    # read-only grid for draw_grid: only the sliced (visible) region is materialized
+    def view(self):
+        return HashLifeView(self)
+
+# np.asarray(view) materializes the whole grid (observables, checkpoints, records)
+class HashLifeView:
+    ndim = 2
+
+    def __init__(self, engine: HashLife):
+        self.engine = engine
+        self.shape = engine.shape
+        self.dtype = engine.dtype
+
+    def __array__(self, dtype=None, copy=None):
+        grid = self.engine.to_array()
+        return grid if dtype is None else grid.astype(dtype)
+
+    def __getitem__(self, key):
+        if not (isinstance(key, tuple) and len(key) == 2 and all(isinstance(k, slice) for k in key)):
+            return np.asarray(self)[key]
+        xs, ys = key
+        x0, x1, sx = xs.indices(self.shape[0])
+        y0, y1, sy = ys.indices(self.shape[1])
+        if sx < 1 or sy < 1:
+            return np.asarray(self)[key]
+        return self.engine.to_array(x0, max(x0, x1), y0, max(y0, y1))[::sx, ::sy]
+
+    def copy(self) -> np.ndarray:
+        return np.asarray(self)
+
+# =-=-= multi-process tiles (shared memory, one-cell halo)
+
+# worker loop: copy own rows + halo from the current buffer, compute own rows of the future buffer
+# copy rows x0:x1 of a toroidal grid into tile, padded with a one-cell halo
+def fill_tile(tile, grid, x0, x1) -> None:
+    dx = grid.shape[0]
+    tile[1:-1, 1:-1] = grid[x0:x1]
+    tile[0, 1:-1] = grid[(x0 - 1) % dx]
+    tile[-1, 1:-1] = grid[x1 % dx]
+    tile[:, 0] = tile[:, -2]
+    tile[:, -1] = tile[:, 1]
+
+def tile_worker(shm_name, shape, dtype, rng_name, w, x0, x1, tile_step, barrier, control, args):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    rng_shm = shared_memory.SharedMemory(name=rng_name)
+    buffers = np.ndarray((2,) + shape, dtype=dtype, buffer=shm.buf)
+    rng_state = np.ndarray((barrier.parties - 1,), dtype=np.uint64, buffer=rng_shm.buf)[w:w + 1]
+    dx, dy = shape
+    tile = np.empty((x1 - x0 + 2, dy + 2), dtype=dtype) # padded with a one-cell halo
+    while True:
+        barrier.wait() # step starts
+        src = control.value
+        if src < 0:
+            break
+        fill_tile(tile, buffers[src], x0, x1)
+        tile_step(tile, buffers[1 - src, x0:x1], rng_state, np.frombuffer(args, dtype=np.float64))
+        barrier.wait() # step done
+    del buffers, rng_state
+    shm.close()
+    rng_shm.close()
+
+# toroidal grid split in row tiles, each owned by a worker process
+# tile_step(tile, out, rng_state, args): tile is the padded (rows + 2, dy + 2) copy, out the rows
+# to write, args the float64 values passed to ca_step (step-dependent parameters).
+# A step raises as soon as a worker exits, or when the workers do not answer within `timeout` seconds.
+class TiledSimulation:
+    def __init__(self, grid, tile_step, n_workers: int = 0, seed: int = None, n_args: int = 8, timeout: float = 60.0):
+        if n_workers <= 0:
+            n_workers = os.cpu_count()
+        self.timeout = timeout
+        self.shape = grid.shape
+        self.dtype = grid.dtype
+        self.shm = shared_memory.SharedMemory(create=True, size=2 * grid.nbytes)
+        self.buffers = np.ndarray((2,) + grid.shape, dtype=grid.dtype, buffer=self.shm.buf)
+        self.buffers[0] = grid
+        self.rng_shm = shared_memory.SharedMemory(create=True, size=8 * n_workers)
+        self.rng_states = np.ndarray((n_workers,), dtype=np.uint64, buffer=self.rng_shm.buf)
+        self.rng_states[:] = make_block_rngs(n_workers, seed)
+        # spawned (not forked): numba's thread pool, once started by a parallel kernel, is not fork-safe.
+        # workers load the kernels compiled here from the on-disk cache
+        ctx = mp.get_context("spawn")
+        self.barrier = ctx.Barrier(n_workers + 1)
+        self.control = ctx.Value("i", 0, lock=False)
+        self.args = ctx.Array("d", n_args, lock=False)
+        warm_up([(tile_step, (np.zeros((3, 3), dtype=grid.dtype), np.zeros((1, 1), dtype=grid.dtype),
+                              np.zeros(1, dtype=np.uint64), np.zeros(n_args)))])
+        self.workers = []
+        for w in range(n_workers):
+            x0, x1 = block_rows(grid.shape[0], w, n_workers)
+            p = ctx.Process(target=tile_worker, args=(self.shm.name, grid.shape, grid.dtype, self.rng_shm.name, w, x0, x1, tile_step, self.barrier, self.control, self.args), daemon=True)
+            p.start()
+            self.workers.append(p)
+        threading.Thread(target=self.watch, daemon=True).start()
+        atexit.register(self.close)
+
+    # run() compatible: (grid, newgrid) are the two shared buffers (zero-copy for draw_grid)
+    def init_simulation(self, params):
+        return self.buffers[0], self.buffers[1]
+
+    # run(resume_from=...): the checkpointed grid is copied into the shared buffers once
+    def resume_simulation(self, params, grid, newgrid):
+        self.buffers[0] = grid
+        return self.buffers[0], self.buffers[1]
+
+    # steps in place: grid and newgrid must be the shared buffers
+    def ca_step(self, grid, newgrid, *args):
+        if np.may_share_memory(grid, self.buffers[0]):
+            self.control.value = 0
+        elif np.may_share_memory(grid, self.buffers[1]):
+            self.control.value = 1
+        else:
+            raise ValueError("grid is not a shared buffer: step the grids returned by init_simulation "
+                             "(or resume_simulation after a checkpoint)")
+        self.args[:len(args)] = args
+        self.wait()
+        self.wait()
+
+    # a worker that exits (e.g. failed at startup) breaks the barrier, so that wait() does not block
+    def watch(self) -> None:
+        mp.connection.wait([p.sentinel for p in self.workers])
+        self.barrier.abort()
+
+    def wait(self) -> None:
+        try:
+            self.barrier.wait(self.timeout)
+        except threading.BrokenBarrierError:
+            for p in self.workers:
+                p.join(0.1)
+            dead = [p.exitcode for p in self.workers if p.exitcode is not None]
+            self.close()
+            if dead:
+                raise RuntimeError(f"{len(dead)} tile worker(s) exited (exit codes {dead})") from None
+            raise RuntimeError(f"tile workers did not answer within {self.timeout} s") from None
+
+    def close(self) -> None:
+        if self.workers:
+            self.control.value = -1
+            try:
+                self.barrier.wait(self.timeout)
+            except threading.BrokenBarrierError:
+                for p in self.workers:
+                    p.terminate()
+            for p in self.workers:
+                p.join()
+            self.workers = []
+            del self.buffers, self.rng_states
+            self.shm.close()
+            self.shm.unlink()
+            self.rng_shm.close()
+            self.rng_shm.unlink()
+
+# =-=-= out-of-core grids (memory-mapped files)
+
+# toroidal grid whose two buffers live in a .npy file mapped in memory, stepped in tiles of rows
+# (about tile_bytes each) that are read (with a one-cell halo) and written once per step, with the
+# same tile_step(tile, out, rng_state, args) kernels as TiledSimulation (one random stream per tile).
+# draw_grid only reads the visible rows. The file persists the state: after every step, the buffer
+# index, step, random streams and `meta` (model values, e.g. initial counts) are written next to it
+# ("<path>.json", replaced atomically), and opening an existing file resumes. Only the other buffer
+# is written during a step, so the state survives a killed process; the data is synced to disk
+# (flush()) every flush_every steps and at exit, a system crash can lose the steps since then.
+class MappedGrids:
+    def __init__(self, path: str, shape, tile_step, dtype=np.uint8, tile_bytes: int = 8 << 20, seed: int = None,
+                 flush_every: int = 100):
+        self.path = path
+        self.flush_every = flush_every
+        self.tile_step = tile_step
+        self.shape = tuple(shape)
+        dx, dy = self.shape
+        self.tile_rows = max(1, min(dx, tile_bytes // (np.dtype(dtype).itemsize * (dy + 2)) - 2))
+        self.n_tiles = -(-dx // self.tile_rows)
+        self.step = 0
+        self.current = 0
+        self.meta = {}
+        if os.path.exists(path) and not os.path.exists(path + ".json"):
+            raise FileNotFoundError(f"{path} has no {path}.json (buffer index, step, random streams): "
+                                    f"cannot resume, remove it to start over")
+        if os.path.exists(path):
+            self.buffers = np.lib.format.open_memmap(path, mode="r+")
+            if self.buffers.shape != (2,) + self.shape:
+                raise ValueError(f"{path}: grid shape {self.buffers.shape[1:]} instead of {self.shape}")
+            with open(path + ".json") as f:
+                state = json.load(f)
+            self.current = state["current"]
+            self.step = state["step"]
+            self.rng_states = np.array(state["rng_states"], dtype=np.uint64)
+            self.meta = state.get("meta", {})
+        else:
+            self.buffers = np.lib.format.open_memmap(path, mode="w+", dtype=dtype, shape=(2,) + self.shape)
+            self.rng_states = make_block_rngs(self.n_tiles, seed)
+        self.tile = np.empty((self.tile_rows + 2, dy + 2), dtype=dtype)
+        self.out = np.empty((self.tile_rows, dy), dtype=dtype)
+        atexit.register(self.flush)
+
+    # (x0, x1) row ranges of the tiles
+    def tiles(self):
+        for t in range(self.n_tiles):
+            yield t * self.tile_rows, min(self.shape[0], (t + 1) * self.tile_rows)
+
+    # run() compatible: (grid, newgrid) are the mapped buffers, current state first
+    def init_simulation(self, params):
+        return self.buffers[self.current], self.buffers[1 - self.current]
+
+    def ca_step(self, grid, newgrid, *args) -> None:
+        args = np.array(args, dtype=np.float64)
+        for t, (x0, x1) in enumerate(self.tiles()):
+            tile = self.tile[:x1 - x0 + 2]
+            fill_tile(tile, grid, x0, x1)
+            out = self.out[:x1 - x0]
+            self.tile_step(tile, out, self.rng_states[t:t + 1], args)
+            newgrid[x0:x1] = out
+        self.current = 0 if np.may_share_memory(newgrid, self.buffers[0]) else 1
+        self.step += 1
+        if self.flush_every > 0 and self.step % self.flush_every == 0:
+            self.flush()
+        else:
+            self.write_state()
+
+    def write_state(self) -> None:
+        with open(self.path + ".json.tmp", "w") as f:
+            json.dump({"current": self.current, "step": self.step, "rng_states": self.rng_states.tolist(),
+                       "meta": self.meta}, f)
+        os.replace(self.path + ".json.tmp", self.path + ".json")
+
+    def flush(self) -> None:
+        self.buffers.flush()
+        self.write_state()
+
+    def close(self) -> None:
+        self.flush()
+        atexit.unregister(self.flush)
+
+# =-=-= startup
+
+# compile the bundled numba kernels, and user kernels given as (function, example args), without running
+# them (no thread pool is started, so it is safe before forking). With cache=True the machine code lands
+# in __pycache__: worker processes and later runs load it instead of compiling on their first step.
+# Returns the time spent.
+def warm_up(kernels=()) -> float:
+    t = time.perf_counter()
+    if numba_typeof is None:
+        return 0.0
+    grid = np.zeros((4, 4), dtype=np.uint8)
+    kernel = RuleTable(2).compile(n_blocks=1, seed=0)
+    bundled = [
+        (block_random, (np.zeros(1, dtype=np.uint64), 0)),
+        (block_rows, (4, 0, 1)),
+        (neighbour_counts_kernel, (grid, kernel.state_index, kernel.offsets, np.zeros((1, 4, 4), dtype=np.uint8))),
+        (rule_table_step, (grid, grid, kernel.outcomes, kernel.thresholds, kernel.state_index,
+                           kernel.offsets, kernel.n, kernel.random, kernel.rng_blocks, kernel.block_counts)),
+    ]
+    for f, args in bundled + list(kernels):
+        if hasattr(f, "compile"):
+            f.compile(tuple(numba_typeof(a) for a in args))
+    return time.perf_counter() - t
+
+# =-=-= checkpoints (save/resume the complete simulation state)
+
+# attributes that are rebuilt when agents are restored (not saved)
+CHECKPOINT_AGENT_SKIP = ("params",)
+
+# RNG states: python's random, numpy's global generator, numba's internal generators (if any)
+def get_rng_states() -> dict:
+    states = {}
+    version, mt, gauss = random.getstate()
+    states["rng_py_version"] = np.array(version)
+    states["rng_py_mt"] = np.array(mt, dtype=np.uint32)
+    states["rng_py_gauss"] = np.array(np.nan if gauss is None else gauss)
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    states["rng_np_keys"] = keys
+    states["rng_np_pos"] = np.array(pos)
+    states["rng_np_gauss"] = np.array((has_gauss, cached_gaussian))
+    if numba_helperlib is not None:
+        for tag, ptr in (("py", numba_helperlib.rnd_get_py_state_ptr()), ("np", numba_helperlib.rnd_get_np_state_ptr())):
+            index, mt = numba_helperlib.rnd_get_state(ptr)
+            states["rng_numba_" + tag + "_index"] = np.array(index)
+            states["rng_numba_" + tag + "_mt"] = np.array(mt, dtype=np.uint32)
+    return states
+
+def set_rng_states(states) -> None:
+    gauss = float(states["rng_py_gauss"])
+    random.setstate((int(states["rng_py_version"]), tuple(int(v) for v in states["rng_py_mt"]), None if math.isnan(gauss) else gauss))
+    has_gauss, cached_gaussian = states["rng_np_gauss"]
+    np.random.set_state(("MT19937", states["rng_np_keys"], int(states["rng_np_pos"]), int(has_gauss), float(cached_gaussian)))
+    if numba_helperlib is not None and "rng_numba_py_mt" in states:
+        for tag, ptr in (("py", numba_helperlib.rnd_get_py_state_ptr()), ("np", numba_helperlib.rnd_get_np_state_ptr())):
+            numba_helperlib.rnd_set_state(ptr, (int(states["rng_numba_" + tag + "_index"]), [int(v) for v in states["rng_numba_" + tag + "_mt"]]))
+
+# agents are stored column-wise (one array per class and attribute), no per-agent pickling
+def pack_agents(agents) -> dict:
+    classes = []
+    columns = {}
+    order = np.empty(len(agents), dtype=np.int32)
+    for i, a in enumerate(agents):
+        cls = type(a)
+        if cls not in classes:
+            classes.append(cls)
+            columns[cls] = {}
+        k = classes.index(cls)
+        order[i] = k
+        for name, value in vars(a).items():
+            if name not in CHECKPOINT_AGENT_SKIP:
+                columns[cls].setdefault(name, []).append(value)
+    packed = {"agents_order": order}
+    names = []
+    for k, cls in enumerate(classes):
+        names.append(cls.__module__ + ":" + cls.__qualname__)
+        for name, values in columns[cls].items():
+            packed["agents_" + str(k) + "_" + name] = np.array(values)
+    packed["agents_classes"] = np.array(json.dumps(names))
+    return packed
+
+def unpack_agents(data, params) -> list:
+    classes = []
+    for name in json.loads(str(data["agents_classes"])):
+        module, qualname = name.split(":")
+        cls = sys.modules[module]
+        for part in qualname.split("."):
+            cls = getattr(cls, part)
+        classes.append(cls)
+    columns = []
+    for k in range(len(classes)):
+        prefix = "agents_" + str(k) + "_"
+        columns.append({key[len(prefix):]: data[key].tolist() for key in data.files if key.startswith(prefix)})
+    agents = []
+    counters = [0] * len(classes)
+    for k in data["agents_order"]:
+        a = classes[k].__new__(classes[k])
+        a.params = params
+        for name, values in columns[k].items():
+            setattr(a, name, values[counters[k]])
+        counters[k] += 1
+        agents.append(a)
+    return agents
+
+# write grids, agents, params, counters and RNG states in a single .npz file
+# (numpy arrays in params, e.g. block RNG states, are stored as arrays, numpy generators by state)
+def save_checkpoint(path: str, it: int, grid, newgrid, agents, params: dict) -> None:
+    arrays = {k: v for k, v in params.items() if isinstance(v, np.ndarray)}
+    generators = {k: v for k, v in params.items() if isinstance(v, np.random.Generator)}
+    data = {
+        "it": np.array(it),
+        "grid": grid,
+        "newgrid": newgrid,
+        "params": np.array(json.dumps({k: v for k, v in params.items() if k not in arrays and k not in generators})),
+        "agent_next_id": np.array(Agent._next_id),
+    }
+    data.update({"params_array_" + k: v for k, v in arrays.items()})
+    data.update({"params_rng_" + k: np.array(json.dumps(v.bit_generator.state)) for k, v in generators.items()})
+    data.update(pack_agents(agents))
+    data.update(get_rng_states())
+    with open(path + ".tmp", "wb") as f: # the previous checkpoint survives an interrupted save
+        np.savez(f, **data)
+    os.replace(path + ".tmp", path)
+
+# returns (it, grid, newgrid, agents) and restores params, Agent._next_id and RNG states
+def load_checkpoint(path: str, params: dict):
+    with np.load(path) as data:
+        params.update(json.loads(str(data["params"])))
+        for key in data.files:
+            if key.startswith("params_array_"):
+                params[key[len("params_array_"):]] = data[key].copy()
+            elif key.startswith("params_rng_"):
+                state = json.loads(str(data[key]))
+                bit_generator = getattr(np.random, state["bit_generator"])()
+                bit_generator.state = state
+                params[key[len("params_rng_"):]] = np.random.Generator(bit_generator)
+        Agent._next_id = int(data["agent_next_id"])
+        agents = unpack_agents(data, params)
+        set_rng_states(data)
+        return int(data["it"]), data["grid"].copy(), data["newgrid"].copy(), agents
+
+# =-=-= record and replay
+
+# file layout: magic line, json header line, then one record per step:
+# (step, kind, nbytes) followed by nbytes of zlib-compressed payload
+RECORD_MAGIC = b"CALIPSOREC1\n"
+RECORD_HEADER = struct.Struct("<qBI")
+RECORD_KEYFRAME = 0
+RECORD_DELTA = 1
+
+# append-only log of per-step grid deltas and agent positions/types (keyframe every N steps)
+class Recorder:
+    def __init__(self, path: str, grid, keyframe_every: int = 100, level: int = 1):
+        self.keyframe_every = keyframe_every
+        self.level = level
+        self.last = None
+        self.last_keyframe = None
+        self.file = open(path, "wb")
+        self.file.write(RECORD_MAGIC)
+        header = {"dx": grid.shape[0], "dy": grid.shape[1], "dtype": grid.dtype.str, "keyframe_every": keyframe_every}
+        self.file.write(json.dumps(header).encode() + b"\n")
+
+    def write(self, step: int, grid, agents) -> None:
+        grid = np.asarray(grid) # lazy grids (HashLife views) are materialized
+        if self.last is None or step - self.last_keyframe >= self.keyframe_every:
+            kind = RECORD_KEYFRAME
+            self.last = grid.copy()
+            self.last_keyframe = step
+            chunks = [grid.tobytes()]
+        else:
+            kind = RECORD_DELTA
+            flat = self.last.reshape(-1)
+            idx = np.flatnonzero(grid.reshape(-1) != flat).astype(np.int32)
+            values = grid.reshape(-1)[idx]
+            flat[idx] = values
+            chunks = [struct.pack("<i", idx.size), idx.tobytes(), values.tobytes()]
+        alive = [a for a in agents if a.running]
+        chunks.append(struct.pack("<i", len(alive)))
+        chunks.append(np.array([(a.x, a.y, a.type) for a in alive], dtype=np.int32).reshape(-1, 3).tobytes())
+        payload = zlib.compress(b"".join(chunks), self.level)
+        self.file.write(RECORD_HEADER.pack(step, kind, len(payload)))
+        self.file.write(payload)
+        if kind == RECORD_KEYFRAME:
+            self.file.flush()
+
+    def close(self) -> None:
+        self.file.close()
+
+# random access reader: seek to the closest keyframe, then apply deltas
+class Recording:
+    def __init__(self, path: str):
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        if self.file.readline() != RECORD_MAGIC:
+            raise ValueError(path + " is not a calipsolib recording")
+        header = json.loads(self.file.readline())
+        self.dx = header["dx"]
+        self.dy = header["dy"]
+        self.dtype = np.dtype(header["dtype"])
+        self.steps = []
+        self.records = []  # (kind, offset, nbytes)
+        self.keyframes = []  # index in self.records
+        while True:
+            raw = self.file.read(RECORD_HEADER.size)
+            if len(raw) < RECORD_HEADER.size:
+                break
+            step, kind, nbytes = RECORD_HEADER.unpack(raw)
+            offset = self.file.tell()
+            if offset + nbytes > size: # truncated last record (interrupted run)
+                break
+            self.file.seek(nbytes, 1)
+            if kind == RECORD_KEYFRAME:
+                self.keyframes.append(len(self.records))
+            self.steps.append(step)
+            self.records.append((kind, offset, nbytes))
+        self.grid = np.zeros((self.dx, self.dy), dtype=self.dtype)
+        self.agents = np.zeros((0, 3), dtype=np.int32)
+        self.index = -1
+
+    def __len__(self):
+        return len(self.records)
+
+    def _apply(self, i: int) -> None:
+        kind, offset, nbytes = self.records[i]
+        self.file.seek(offset)
+        payload = zlib.decompress(self.file.read(nbytes))
+        if kind == RECORD_KEYFRAME:
+            size = self.dx * self.dy * self.dtype.itemsize
+            self.grid[:] = np.frombuffer(payload, dtype=self.dtype, count=self.dx * self.dy).reshape(self.dx, self.dy)
+            pos = size
+        else:
+            n = struct.unpack_from("<i", payload, 0)[0]
+            idx = np.frombuffer(payload, dtype=np.int32, count=n, offset=4)
+            values = np.frombuffer(payload, dtype=self.dtype, count=n, offset=4 + 4 * n)
+            self.grid.reshape(-1)[idx] = values
+            pos = 4 + 4 * n + n * self.dtype.itemsize
+        m = struct.unpack_from("<i", payload, pos)[0]
+        self.agents = np.frombuffer(payload, dtype=np.int32, count=3 * m, offset=pos + 4).reshape(m, 3)
+        self.index = i
+
+    # move to record i (forward: apply deltas, backward: restart from a keyframe)
+    def seek(self, i: int) -> None:
+        i = max(0, min(i, len(self.records) - 1))
+        if i == self.index:
+            return
+        k = max(j for j in self.keyframes if j <= i)
+        start = self.index + 1 if k <= self.index < i else k
+        for j in range(start, i + 1):
+            self._apply(j)
+
+    def close(self) -> None:
+        self.file.close()
+
+# play back a recording with the same rendering, zoom and camera as run()
+def replay(
+    path: str,
+    *,
+    colors_ca: dict,
+    colors_agents: dict = None,
+    display_dx: int = 800, # default value
+    display_dy: int = 800, # default value
+    title: str = "replay", # default value
+    fps: int = 60,
+    mipmap: bool = False, # averaged-colour pyramid when the grid is larger than the window
+) -> None:
+    # keys: space pause, b reverse, n/shift+n one step forward/backward, d/shift+d speed, shift+r go to start
+    rec = Recording(path)
+    dx, dy = rec.dx, rec.dy
+
+    color_ca_lut = build_color_lut(colors_ca)
+    color_agents_lut = build_color_lut(colors_agents) if colors_agents is not None else None
+
+    pyramid = None
+    n_levels = ColorPyramid.levels_for(dx, dy, display_dx, display_dy)
+    if mipmap and n_levels > 0:
+        pyramid = ColorPyramid(color_ca_lut, (dx, dy), n_levels)
+
+    speeds = (1, 10, 100, 1000) # records per frame
+    speed_idx = 0
+    direction = 1
+    paused = False
+
+    zoom = 1.0
+    move_span_init = max(dx, dy) / 10
+    cx, cy = (dx - 1) / 2.0, (dy - 1) / 2.0
+
+    load_pygame().init()
+    screen = pygame.display.set_mode((display_dx, display_dy))
+    pygame.display.set_caption(title)
+    clock = pygame.time.Clock()
+    font = pygame.font.SysFont(None, 24)
+
+    target = 0
+    rec.seek(target)
+
+    running = True
+    while running:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                running = False
+
+            elif event.type == pygame.KEYDOWN:
+                shift = bool(pygame.key.get_mods() & pygame.KMOD_SHIFT)
+                if event.key == pygame.K_SPACE:
+                    paused = not paused
+                elif event.key == pygame.K_b:
+                    direction = -direction
+                elif event.key == pygame.K_n:
+                    target += -1 if shift else 1
+                elif event.key == pygame.K_d:
+                    speed_idx = (speed_idx - 1) % len(speeds) if shift else (speed_idx + 1) % len(speeds)
+                elif event.key == pygame.K_r and shift:
+                    target = 0
+                else:
+                    zoom, cx, cy = camera_key(event.key, shift, zoom, cx, cy, dx, dy, move_span_init)
+
+        cx, cy = camera_held(zoom, cx, cy, dx, dy, move_span_init)
+        cx, cy = clamp_camera(cx, cy, dx, dy, display_dx, display_dy, zoom)
+
+        if not paused:
+            target += direction * speeds[speed_idx]
+        target = max(0, min(target, len(rec) - 1))
+        rec.seek(target)
+
+        agents = [SimpleNamespace(x=int(x), y=int(y), type=int(t), running=True) for x, y, t in rec.agents]
+        screen.fill((0, 0, 0))
+        draw_grid(screen, rec.grid, dx, dy, display_dx, display_dy, zoom, cx, cy, agents, color_ca_lut, color_agents_lut, pyramid)
+        text_surf = font.render(f"step {rec.steps[rec.index]} / {rec.steps[-1]}, x{direction * speeds[speed_idx]}" + (" (paused)" if paused else ""), True, (128, 0, 0))
+        screen.blit(text_surf, (10, 10))
+        pygame.display.flip()
+        clock.tick(fps)
+
+    rec.close()
+    pygame.quit()
+
+# =-=-= remote viewer (headless simulation -> viewer process over a socket)
+
+VIEW_HEADER = struct.Struct("<qB5iI") # step, kind, x0, y0, nx, ny, stride, payload length
+
+def view_socket(address):
+    family = socket.AF_UNIX if isinstance(address, str) else socket.AF_INET
+    return socket.socket(family, socket.SOCK_STREAM)
+
+def recv_exactly(sock, n: int) -> bytes:
+    chunks = []
+    while n > 0:
+        chunk = sock.recv(n)
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b"".join(chunks)
+
+# one connected viewer: its viewport (x0, x1, y0, y1, stride, in grid cells) and the last region sent,
+# so that a frame is a delta when the viewport did not change
+class ViewerConnection:
+    def __init__(self, sock, shape):
+        self.sock = sock
+        self.shape = shape
+        self.viewport = None # nothing is sent before the viewer subscribes
+        self.last = None
+        self.last_viewport = None
+        self.frame = None # latest frame waiting for the sender (older ones are dropped)
+        self.ready = threading.Event()
+        self.ready.set()
+        self.pending = threading.Event()
+        self.closed = False
+        threading.Thread(target=self._reader, daemon=True).start()
+        threading.Thread(target=self._sender, daemon=True).start()
+
+    def _reader(self) -> None:
+        try:
+            for line in self.sock.makefile("rb"):
+                viewport = self.parse_viewport(line)
+                if viewport is not None: # malformed messages are dropped
+                    self.viewport = viewport
+        except OSError:
+            pass
+        self.closed = True
+        self.pending.set()
+
+    # (x0, x1, y0, y1, stride) clamped to the grid, stride >= 1, or None
+    def parse_viewport(self, line):
+        try:
+            x0, x1, y0, y1, stride = (int(v) for v in json.loads(line)["viewport"])
+        except (ValueError, TypeError, KeyError, IndexError):
+            return None
+        dx, dy = self.shape
+        x0 = min(max(x0, 0), dx)
+        y0 = min(max(y0, 0), dy)
+        return x0, min(max(x1, x0), dx), y0, min(max(y1, y0), dy), max(1, stride)
+
+    def _sender(self) -> None:
+        while True:
+            self.pending.wait()
+            self.pending.clear()
+            if self.closed:
+                break
+            step, viewport, region, positions = self.frame
+            if viewport == self.last_viewport:
+                kind = RECORD_DELTA
+                flat = self.last.reshape(-1)
+                idx = np.flatnonzero(region.reshape(-1) != flat).astype(np.int32)
+                values = region.reshape(-1)[idx]
+                flat[idx] = values
+                chunks = [struct.pack("<i", idx.size), idx.tobytes(), values.tobytes()]
+            else:
+                kind = RECORD_KEYFRAME
+                self.last = region.copy()
+                self.last_viewport = viewport
+                chunks = [region.tobytes()]
+            chunks.append(struct.pack("<i", len(positions)))
+            chunks.append(positions.tobytes())
+            payload = zlib.compress(b"".join(chunks), 1)
+            x0, x1, y0, y1, stride = viewport
+            try:
+                self.sock.sendall(VIEW_HEADER.pack(step, kind, x0, y0, region.shape[0], region.shape[1], stride, len(payload)) + payload)
+            except OSError:
+                self.closed = True
+                break
+            self.ready.set()
+        self.sock.close()
+
+# publishes the grid and agents to remote viewers (see view) over TCP ((host, port)) or a Unix socket (path).
+# publish() never blocks: a viewer still sending its previous frame skips this one, and only its
+# viewport (subsampled by its stride) is copied
+class Publisher:
+    def __init__(self, address, grid):
+        self.address = address
+        self.shape = grid.shape
+        self.header = json.dumps({"dx": grid.shape[0], "dy": grid.shape[1], "dtype": grid.dtype.str}).encode() + b"\n"
+        self.viewers = []
+        if isinstance(address, str) and os.path.exists(address):
+            os.remove(address)
+        self.server = view_socket(address)
+        if not isinstance(address, str):
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen()
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, _ = self.server.accept()
+                sock.sendall(self.header)
+            except OSError:
+                break
+            self.viewers.append(ViewerConnection(sock, self.shape))
+
+    def publish(self, step: int, grid, agents) -> None:
+        for v in list(self.viewers): # the accept thread appends concurrently
+            if v.closed:
+                self.viewers.remove(v)
+            if v.closed or v.viewport is None or not v.ready.is_set():
+                continue # dropped frame
+            x0, x1, y0, y1, stride = v.viewport
+            region = np.ascontiguousarray(grid[x0:x1:stride, y0:y1:stride])
+            positions = np.array([(a.x, a.y, a.type) for a in agents
+                                  if a.running and x0 <= a.x < x1 and y0 <= a.y < y1], dtype=np.int32).reshape(-1, 3)
+            v.ready.clear()
+            v.frame = (step, v.viewport, region, positions)
+            v.pending.set()
+
+    def close(self) -> None:
+        self.server.close()
+        for v in self.viewers:
+            v.closed = True
+            v.pending.set()
+            try:
+                v.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+# viewer side: the latest region received, read by draw_grid as a grid of shape `shape`
+# (cells outside the region read as 0)
+class RemoteGrid:
+    def __init__(self, shape, dtype):
+        self.shape = shape
+        self.dtype = dtype
+        self.region = np.zeros((0, 0), dtype=dtype)
+        self.origin = (0, 0)
+
+    def __getitem__(self, key):
+        xs, ys = key
+        x0, x1, _ = xs.indices(self.shape[0])
+        y0, y1, _ = ys.indices(self.shape[1])
+        out = np.zeros((x1 - x0, y1 - y0), dtype=self.dtype)
+        ox, oy = self.origin
+        nx, ny = self.region.shape
+        ax0, ax1 = max(x0, ox), min(x1, ox + nx)
+        ay0, ay1 = max(y0, oy), min(y1, oy + ny)
+        if ax0 < ax1 and ay0 < ay1:
+            out[ax0 - x0:ax1 - x0, ay0 - y0:ay1 - y0] = self.region[ax0 - ox:ax1 - ox, ay0 - oy:ay1 - oy]
+        return out
+
+# thin viewer client for a simulation running with run(..., publish_address=address). When zoomed out,
+# it subscribes to one cell out of `stride` and draws that subsampled world at full resolution.
+def view(
+    address,
+    *,
+    colors_ca: dict,
+    colors_agents: dict = None,
+    display_dx: int = 800, # default value
+    display_dy: int = 800, # default value
+    title: str = "remote view", # default value
+    fps: int = 30,
+) -> None:
+    sock = view_socket(address)
+    sock.connect(address)
+    stream = sock.makefile("rb")
+    header = json.loads(stream.readline())
+    dx, dy = header["dx"], header["dy"]
+    dtype = np.dtype(header["dtype"])
+
+    color_ca_lut = build_color_lut(colors_ca)
+    color_agents_lut = build_color_lut(colors_agents) if colors_agents is not None else None
+
+    latest = SimpleNamespace(step=-1, viewport=None, region=None, positions=np.zeros((0, 3), dtype=np.int32))
+
+    def receiver():
+        region = None
+        try:
+            while True:
+                step, kind, x0, y0, nx, ny, stride, size = VIEW_HEADER.unpack(stream.read(VIEW_HEADER.size))
+                data = zlib.decompress(stream.read(size))
+                if kind == RECORD_KEYFRAME:
+                    offset = nx * ny * dtype.itemsize
+                    region = np.frombuffer(data[:offset], dtype=dtype).reshape(nx, ny).copy()
+                else:
+                    n = struct.unpack_from("<i", data)[0]
+                    idx = np.frombuffer(data, dtype=np.int32, count=n, offset=4)
+                    values = np.frombuffer(data, dtype=dtype, count=n, offset=4 + 4 * n)
+                    region = region.copy()
+                    region.reshape(-1)[idx] = values
+                    offset = 4 + n * (4 + dtype.itemsize)
+                n_agents = struct.unpack_from("<i", data, offset)[0]
+                positions = np.frombuffer(data, dtype=np.int32, count=3 * n_agents, offset=offset + 4).reshape(-1, 3)
+                latest.region, latest.viewport, latest.positions, latest.step = region, (x0, y0, stride), positions, step
+        except (struct.error, ConnectionError, OSError, zlib.error):
+            latest.step = None
+
+    threading.Thread(target=receiver, daemon=True).start()
+
+    zoom = 1.0
+    move_span_init = max(dx, dy) / 10
+    cx, cy = (dx - 1) / 2.0, (dy - 1) / 2.0
+    subscribed = None
+
+    load_pygame().init()
+    screen = pygame.display.set_mode((display_dx, display_dy))
+    pygame.display.set_caption(title)
+    clock = pygame.time.Clock()
+    font = pygame.font.SysFont(None, 24)
+
+    running = True
+    while running and latest.step is not None:
+        for event in pygame.event.get():
+            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                running = False
+            elif event.type == pygame.KEYDOWN:
+                shift = bool(pygame.key.get_mods() & pygame.KMOD_SHIFT)
+                zoom, cx, cy = camera_key(event.key, shift, zoom, cx, cy, dx, dy, move_span_init)
+
+        cx, cy = camera_held(zoom, cx, cy, dx, dy, move_span_init)
+        cx, cy = clamp_camera(cx, cy, dx, dy, display_dx, display_dy, zoom)
+
+        # subsampled world (one cell out of `stride`), drawn with cells of at least one pixel
+        stride = max(1, int(1.0 / (min(display_dx / dx, display_dy / dy) * zoom)))
+        sdx, sdy = -(-dx // stride), -(-dy // stride)
+        _, _, _, ix0, iy0, ix1, iy1, _, _ = grid_view(sdx, sdy, display_dx, display_dy, zoom, cx / stride, cy / stride)
+        viewport = (ix0 * stride, ix1 * stride, iy0 * stride, iy1 * stride, stride)
+        if viewport != subscribed:
+            sock.sendall(json.dumps({"viewport": viewport}).encode() + b"\n")
+            subscribed = viewport
+
+        grid = RemoteGrid((sdx, sdy), dtype)
+        agents = []
+        if latest.region is not None and latest.viewport[2] == stride:
+            x0, y0, _ = latest.viewport
+            grid.region, grid.origin = latest.region, (x0 // stride, y0 // stride)
+        if latest.region is not None and latest.viewport[2] == stride and color_agents_lut is not None:
+            agents = [SimpleNamespace(x=int(x) // stride, y=int(y) // stride, type=int(t), running=True) for x, y, t in latest.positions]
+
+        screen.fill((0, 0, 0))
+        draw_grid(screen, grid, sdx, sdy, display_dx, display_dy, zoom, cx / stride, cy / stride, agents, color_ca_lut, color_agents_lut)
+        text_surf = font.render(f"step {latest.step}" + (f", 1/{stride} cells" if stride > 1 else ""), True, (128, 0, 0))
+        screen.blit(text_surf, (10, 10))
+        pygame.display.flip()
+        clock.tick(fps)
+
+    sock.close()
+    pygame.quit()
+
 # entry point for user to launch the simulation
 def run(
     *,
     params: dict,
     init_simulation,  # defined by user: (params) -> (grid, newgrid)
     ca_step,          # defined by user: (grid, newgrid, densite, ...) -> None
-    colors: dict,
+    colors_ca: dict,
+    colors_agents: dict,
     make_agents=None, # defined by user: (params) -> list[agent]
-    dx: int = 800,    # default value
-    dy: int = 800,    # default value
+    dx: int = 80, # default value
+    dy: int = 80, # default value
     display_dx: int = 800, # default value
     display_dy: int = 800, # default value
     title: str = "no name", # default value
     verbose: bool = False,
     fps: int = 60,
     max_simulation_steps: int = -1, # max simulation steps, default is -1, i.e., infinite
+    headless: bool = False, # no window, no rendering (batch runs)
+    checkpoint_path: str = "checkpoint.npz", # written with "s" key or every checkpoint_every steps
+    checkpoint_every: int = -1, # periodic checkpoints, default is -1, i.e., never
+    resume_from: str = None, # checkpoint file to resume from
+    resume_simulation=None, # (params, grid, newgrid) -> (grid, newgrid): adopt checkpointed grids, default: that of init_simulation's object (HashLife)
+    record_path: str = None, # record grid deltas and agents for replay()
+    record_keyframe_every: int = 100, # full grid every N recorded steps
+    mipmap: bool = False, # averaged-colour pyramid when the grid is larger than the window
+    export_path: str = None, # "frames/frame_%06d.png" (PNG sequence) or a video file (needs ffmpeg)
+    export_every: int = 1, # export a frame every N steps
+    export_fps: int = 30, # frame rate of exported videos
+    charts: dict = None, # live strip chart, name -> callable(grid, agents) or (callable, color), sampled every step
+    chart_length: int = 500, # number of steps shown in the strip chart
+    observables: Observables = None, # per-step metrics table (see Observables)
+    termination: Termination = None, # early stop (see Termination), reason in termination.reason
+    publish_address = None, # ("127.0.0.1", port) or a Unix socket path: stream frames to remote viewers (see view)
+    metrics_port: int = None, # serve live counters on http://127.0.0.1:<port>/metrics (see MetricsServer)
+    allocations: AllocationProfiler = None, # per-phase allocation profile (tracemalloc), see allocations.report()
+    agent_update: SynchronousUpdate = None, # agents propose/apply from a common snapshot instead of move() in list order
 ) -> None:
 
     sps_last_t = time.perf_counter() # sps: steps per seconds (can be lower or equal to fps -- used for monitoring)
     sps_count = 0
     sps_value = 0.0
 
-    max_simulation_steps = -1
     it = 0
 
-    render_periods = (1, 60, 600) # simulation speed (changes with "d" key during simulation)
+    render_periods = (1, 60, 6000) # simulation speed (changes with "d" key during simulation)
     render_idx = 0
     render_every = render_periods[render_idx]
 
-    color_lut = build_color_lut(colors) # opt. for rendering
+    color_ca_lut = build_color_lut(colors_ca)
+    if colors_agents != None:
+        color_agents_lut = build_color_lut(colors_agents)
+    else:
+        color_agents_lut = None
 
     params["dx"] = dx
-    params["dy"] = dy
+    params["dy"] = dy 
 
-    current_world_state, future_world_state = init_simulation(params)
+    if resume_from is not None:
+        it, current_world_state, future_world_state, agents = load_checkpoint(resume_from, params)
+        if resume_simulation is None:
+            resume_simulation = getattr(getattr(init_simulation, "__self__", None), "resume_simulation", None)
+        if resume_simulation is not None:
+            current_world_state, future_world_state = resume_simulation(params, current_world_state, future_world_state)
+        if observables is not None:
+            observables.resume(it)
+    else:
+        current_world_state, future_world_state = init_simulation(params)
+        agents = make_agents(params) if make_agents is not None else []
+
+    if agent_update is not None: # seed kept in params, hence in checkpoints
+        if resume_from is not None and "agent_update_seed" in params:
+            agent_update.seed = params["agent_update_seed"]
+        elif agent_update.seed is None:
+            agent_update.seed = random.getrandbits(64)
+        params["agent_update_seed"] = agent_update.seed
 
-    agents = make_agents(params) if make_agents is not None else []
+    recorder = None
+    if record_path is not None:
+        recorder = Recorder(record_path, current_world_state, record_keyframe_every)
+        recorder.write(it, current_world_state, agents)
 
     zoom = 1.0
     move_span_init = max(dx, dy) / 10
-    move_span = move_span_init
 
     cx, cy = (dx - 1) / 2.0, (dy - 1) / 2.0
 
-    pygame.init()
-    screen = pygame.display.set_mode((display_dx, display_dy))
-    pygame.display.set_caption(title)
+    pyramid = None
+    n_levels = ColorPyramid.levels_for(dx, dy, display_dx, display_dy)
+    if mipmap and n_levels > 0:
+        pyramid = ColorPyramid(color_ca_lut, (dx, dy), n_levels)
 
-    clock = pygame.time.Clock()
-    SHOW_FPS = True
-    MAX_FPS = fps
-    font = pygame.font.SysFont(None, 24)
+    exporter = None
+    if export_path is not None:
+        exporter = FrameExporter(export_path, display_dx, display_dy, export_fps)
+
+    publisher = None
+    if publish_address is not None:
+        publisher = Publisher(publish_address, current_world_state)
+
+    chart = None
+    if charts and not headless:
+        chart = StripChart(charts, chart_length)
+
+    phases = allocations if allocations is not None else PhaseTimer()
+    metrics = None
+    if metrics_port is not None:
+        metrics = MetricsServer(metrics_port)
+        metrics.update(step=it)
+
+    if not headless:
+        load_pygame().init()
+        screen = pygame.display.set_mode((display_dx, display_dy))
+        pygame.display.set_caption(title)
+
+        clock = pygame.time.Clock()
+        SHOW_FPS = True
+        MAX_FPS = fps
+        font = pygame.font.SysFont(None, 24)
 
     running = True
 
+    phases.begin()
+
     while running and it != max_simulation_steps:
 
         if it % 10 == 0 and verbose:
             print(str(it))
 
-        pygame.event.pump()
+        if checkpoint_every > 0 and it > 0 and it % checkpoint_every == 0:
+            save_checkpoint(checkpoint_path, it, current_world_state, future_world_state, agents, params)
 
-        for event in pygame.event.get():
-            if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
-                running = False
-                return
+        if exporter is not None and it % export_every == 0:
+            exporter.write(current_world_state, dx, dy, zoom, cx, cy, agents, color_ca_lut, color_agents_lut, pyramid)
 
-            elif event.type == pygame.KEYDOWN:
-                mods = pygame.key.get_mods()
-                shift = bool(mods & pygame.KMOD_SHIFT)
+        if not headless:
+            pygame.event.pump()
 
-                if event.key == pygame.K_z:
-                    zoom = zoom * 1.1 if shift else zoom / 1.1
-                    if zoom < 1.0:
-                        zoom = 1.0
-                    move_span = move_span_init / zoom
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                    running = False
 
-                elif event.key == pygame.K_d:
-                    render_idx = (render_idx - 1) % len(render_periods) if shift else (render_idx + 1) % len(render_periods)
-                    render_every = render_periods[render_idx]
-                    print("render every", render_every, "frames")
+                elif event.type == pygame.KEYDOWN:
+                    mods = pygame.key.get_mods()
+                    shift = bool(mods & pygame.KMOD_SHIFT)
+
+                    if event.key == pygame.K_d:
+                        render_idx = (render_idx - 1) % len(render_periods) if shift else (render_idx + 1) % len(render_periods)
+                        render_every = render_periods[render_idx]
+                        print("render every", render_every, "frames")
 
-                elif event.key == pygame.K_r:
-                    if shift:
+                    elif event.key == pygame.K_c and chart is not None:
+                        chart.visible = not chart.visible
+
+                    elif event.key == pygame.K_s:
+                        save_checkpoint(checkpoint_path, it, current_world_state, future_world_state, agents, params)
+                        print("checkpoint saved to", checkpoint_path, "at step", it)
+
+                    elif event.key == pygame.K_r and shift:
                         current_world_state, future_world_state = init_simulation(params)
+                        agents = make_agents(params) if make_agents is not None else []
+
                     else:
-                        zoom = 1.0
-                        cx, cy = (dx - 1) / 2.0, (dy - 1) / 2.0
-
-                elif event.key in (pygame.K_LEFT, pygame.K_RIGHT, pygame.K_UP, pygame.K_DOWN):
-                    if event.key == pygame.K_LEFT:
-                        cx = max(0, cx - move_span)
-                    elif event.key == pygame.K_RIGHT:
-                        cx = min(dx - 1, cx + move_span)
-                    elif event.key == pygame.K_UP:
-                        cy = max(0, cy - move_span)
-                    elif event.key == pygame.K_DOWN:
-                        cy = min(dy - 1, cy + move_span)
-
-        if not running:
-            break
+                        zoom, cx, cy = camera_key(event.key, shift, zoom, cx, cy, dx, dy, move_span_init)
 
-        keys = pygame.key.get_pressed()
-        shift_held = bool(pygame.key.get_mods() & pygame.KMOD_SHIFT)
-        if shift_held:
-            if keys[pygame.K_LEFT]:
-                cx = max(0, cx - move_span)
-            if keys[pygame.K_RIGHT]:
-                cx = min(dx - 1, cx + move_span)
-            if keys[pygame.K_UP]:
-                cy = max(0, cy - move_span)
-            if keys[pygame.K_DOWN]:
-                cy = min(dy - 1, cy + move_span)
+            if not running:
+                break
 
-        cx, cy = clamp_camera(cx, cy, dx, dy, display_dx, display_dy, zoom)
+            cx, cy = camera_held(zoom, cx, cy, dx, dy, move_span_init)
+            cx, cy = clamp_camera(cx, cy, dx, dy, display_dx, display_dy, zoom)
 
-        do_draw = (it % render_every == 0)
-        if do_draw:
-            screen.fill((0, 0, 0))
-            draw_grid(screen, current_world_state, dx, dy, display_dx, display_dy, zoom, cx, cy, agents, color_lut)
+            do_draw = (it % render_every == 0)
+            if do_draw:
+                screen.fill((0, 0, 0))
+                draw_grid(screen, current_world_state, dx, dy, display_dx, display_dy, zoom, cx, cy, agents, color_ca_lut, color_agents_lut, pyramid)
 
-            if SHOW_FPS:
-                text_surf = font.render(f"{clock.get_fps():.1f} FPS, {sps_value:.0f} SPS", True, (128, 0, 0))
-                screen.blit(text_surf, (10, 10))
+                if SHOW_FPS:
+                    SHOW_FPS_COLORS = [(128, 0, 0), (0, 128, 0), (0, 0, 128)]
+                    text_surf = font.render(f"{clock.get_fps():.1f} FPS, {sps_value:.0f} SPS", True, SHOW_FPS_COLORS[random.randint(0,2)])
+                    screen.blit(text_surf, (10, 10))
 
-            pygame.display.flip()
-            clock.tick(MAX_FPS)
+                if chart is not None:
+                    chart.draw(screen, font, (0, display_dy * 2 // 3, display_dx, display_dy // 3))
 
-        for a in agents:
-            try:
-                a.move(params)
-            except TypeError:
-                a.move()
+                pygame.display.flip()
+                clock.tick(MAX_FPS)
+
+        phases.mark("render")
+
+        if agent_update is not None:
+            agent_update.step(current_world_state, agents, it)
+        else:
+            for a in agents:
+                a.move(current_world_state,agents)
+
+        phases.mark("agents")
 
         ca_step(current_world_state, future_world_state)
 
         current_world_state, future_world_state = future_world_state, current_world_state
 
         it += 1
+
+        phases.mark("ca_step")
+
+        if observables is not None and it % observables.every == 0:
+            observables.sample(it, current_world_state, agents)
+
+        if chart is not None:
+            chart.sample(current_world_state, agents)
+
+        if termination is not None and termination.reason is None:
+            values = observables.last if observables is not None else {}
+            if termination.check(it, current_world_state, agents, values) is not None:
+                if termination.action == "fast_forward" and termination.period is not None and max_simulation_steps > 0:
+                    it += (max_simulation_steps - it) // termination.period * termination.period
+                    if verbose:
+                        print("step", termination.step, ":", termination.reason, ", fast-forward to", it)
+                else:
+                    if verbose:
+                        print("step", it, ":", termination.reason, ", stop")
+                    running = False
+
+        phases.mark("observe")
+
+        if recorder is not None:
+            recorder.write(it, current_world_state, agents)
+
+        if publisher is not None:
+            publisher.publish(it, current_world_state, agents)
+
+        phases.mark("output")
+        phases.end_step(it)
+
         sps_count += 1
         now = time.perf_counter()
         dt = now - sps_last_t
         if dt >= 1.0:
             sps_value = sps_count / dt
+            phase_ms = phases.collect(sps_count)
             sps_count = 0
             sps_last_t = now
+            if metrics is not None:
+                if observables is not None:
+                    populations = dict(observables.last)
+                else:
+                    populations = {}
+                    for a in agents:
+                        if a.running:
+                            populations[str(a.type)] = populations.get(str(a.type), 0) + 1
+                metrics.update(step=it, steps_per_second=sps_value, phase_ms=phase_ms, populations=populations,
+                               agents=len(agents), memory_rss_bytes=memory_rss())
 
-    pygame.quit()
+    if recorder is not None:
+        recorder.close()
+
+    if exporter is not None:
+        exporter.close()
+
+    if publisher is not None:
+        publisher.close()
+
+    if metrics is not None:
+        metrics.close()
+
+    if agent_update is not None:
+        agent_update.close()
+
+    if allocations is not None:
+        allocations.close()
+        if verbose:
+            print(allocations.report())
+
+    if observables is not None:
+        observables.close()
+
+    if not headless:
+        pygame.quit()
+
+# K independent replicas of a grid model stepped as one (K, dx, dy) array, headless: init_simulation(params)
+# returns the two (K, dx, dy) grids (params["n_replicas"] = K), ca_step(grid, newgrid) steps all replicas
+# at once (e.g. a numba kernel with prange over replicas and one random stream each, see make_block_rngs).
+# observables get one row per replica and step. Returns the final grids.
+def run_ensemble(
+    *,
+    params,
+    init_simulation,
+    ca_step,
+    n_replicas: int,
+    dx: int = 80,
+    dy: int = 80,
+    max_simulation_steps: int = 1000,
+    observables: Observables = None,
+    verbose: bool = False,
+) -> np.ndarray:
+
+    params["dx"] = dx
+    params["dy"] = dy
+    params["n_replicas"] = n_replicas
+
+    current_world_state, future_world_state = init_simulation(params)
+
+    t = time.perf_counter()
+    for it in range(1, max_simulation_steps + 1):
+        ca_step(current_world_state, future_world_state)
+        current_world_state, future_world_state = future_world_state, current_world_state
+
+        if observables is not None and it % observables.every == 0:
+            observables.sample(it, current_world_state, [])
+
+        if it % 100 == 0 and verbose:
+            print(f"{it} ({n_replicas * it / (time.perf_counter() - t):.0f} replica steps/s)")
+
+    if observables is not None:
+        observables.close()
+
+    return current_world_state
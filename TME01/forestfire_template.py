@@ -4,14 +4,12 @@
 # Calipsomulator - a simple CA and Agent-based simulator
 # 2026, nb@su
 # 
-# GUI: curseur, z, shift+z, d, shift+d, reset, shift-reset
+# GUI: curseur, z, shift+z, d, shift+d, s (checkpoint), reset, shift-reset
 #
 
-import matplotlib.pyplot as plt
 import random
 import numpy as np
-from numba import njit
-import csv
+from numba import njit, prange
 import calipsolib
 
 # =-=-= Defining cell types
@@ -28,22 +26,57 @@ colors = {
     ASH: (0, 0, 0)
 }
 
-# global variables
-
-iteration = 1
-total_trees_start = 0
-
-# creation csv file
-
-file = open('./TME01/trees.csv', mode='w')
-file.close()
-
 # =-=-= simulation parameters
 
 params = {
     "density": 0.50,
+    "iteration": 1,
+    "total_trees_start": 0,
+    "P_fire": 0.002, # probability that a tree burns (after iteration 70)
+    "P_tree": 0.006, # probability that a new tree grows (after iteration 70)
+    "rare_events": False, # sample the spontaneous fires/growths directly instead of one draw per cell
+    "parallel": False, # multi-core ca_step (row blocks, one random stream per block)
+    "n_blocks": 0, # number of row blocks, 0: one per numba thread
+    "processes": 0, # > 0: grid split in row tiles stepped by worker processes (shared memory)
+    "boundary": None, # "periodic", "fixed" (empty border) or "reflective": grids with a one-cell halo, no modulo
+    "n_replicas": 0, # > 0 (set by calipsolib.run_ensemble): (n_replicas, dx, dy) grids, one random stream per replica
+    "memmap_path": None, # e.g. "forest.npy": grids in a memory-mapped file (larger than RAM), resumed if it exists
 }
 
+tiled = None # calipsolib.TiledSimulation when params["processes"] > 0
+
+# worker processes, (re)started for this grid; their random streams are copied to params["rng_tiles"]
+# after each step (saved in checkpoints), so that resume_simulation continues them
+def start_tiled(grid):
+    global tiled
+    if tiled is not None:
+        tiled.close()
+    tiled = calipsolib.TiledSimulation(grid, ca_step_tile, params["processes"], n_args=3)
+    if "rng_tiles" in params and params["rng_tiles"].shape == tiled.rng_states.shape:
+        tiled.rng_states[:] = params["rng_tiles"]
+    params["rng_tiles"] = tiled.rng_states.copy()
+    return tiled
+
+# run(resume_from=...) does not call init_simulation: the worker processes are started here, with
+# the checkpointed grid loaded into their shared buffers once (then stepped in place)
+def resume_simulation(params, grid, newgrid):
+    if params["processes"] > 0 and grid.ndim == 2:
+        return start_tiled(grid).resume_simulation(params, grid, newgrid)
+    return grid, newgrid
+
+random_events = calipsolib.RandomEvents() # spontaneous fires and growths (serial ca_step)
+
+halo = None # calipsolib.Halo when params["boundary"] is set
+
+# built on first use: run(resume_from=...) does not call init_simulation
+def get_halo():
+    global halo
+    if halo is None or halo.mode != params["boundary"]:
+        halo = calipsolib.Halo(1, params["boundary"], fill=EMPTY)
+    return halo
+
+mapped = None # calipsolib.MappedGrids when params["memmap_path"] is set
+
 # =-=-= user-defined agents
 
 def make_agents(params): # DO NOTHING
@@ -53,6 +86,7 @@ def make_agents(params): # DO NOTHING
 
 # Check the neighbors of a grid
 
+@njit(cache=True)
 def check_FIRE (grid, x, y, dx, dy) :
     if grid[(x-1)%dx, y] == FIRE : return True
 
@@ -75,14 +109,24 @@ def check_FIRE (grid, x, y, dx, dy) :
 # Initialising the simulation
 
 def init_simulation(params):
-    global total_trees_start
-    
+    global mapped
+
     density = params["density"]
     dx = params["dx"]
     dy = params["dy"]
 
-    grid = np.zeros((dx, dy), dtype=np.uint8)
-    newgrid = np.empty((dx, dy), dtype=np.uint8)
+    if params["memmap_path"] is not None:
+        return init_mapped(params)
+
+    if params["n_replicas"] > 0:
+        return init_ensemble(params)
+
+    if params["boundary"] is not None:
+        grid = get_halo().zeros((dx, dy), np.uint8)
+        newgrid = get_halo().empty((dx, dy), np.uint8)
+    else:
+        grid = np.zeros((dx, dy), dtype=np.uint8)
+        newgrid = np.empty((dx, dy), dtype=np.uint8)
 
     for x in range (dx) :
         for y in range (dy) :
@@ -91,54 +135,211 @@ def init_simulation(params):
     
     grid[dx // 2, dy // 2] = FIRE
     
-    total_trees_start = np.sum(grid == TREE)
+    params["total_trees_start"] = int(np.sum(grid == TREE))
+
+    params["rng"] = calipsolib.make_rng()
+
+    if params["parallel"]:
+        params["rng_blocks"] = calipsolib.make_block_rngs(params["n_blocks"])
+
+    if params["boundary"] is not None:
+        params["rng_halo"] = calipsolib.make_block_rngs(1)
+
+    if params["processes"] > 0:
+        params.pop("rng_tiles", None)
+        return start_tiled(grid).init_simulation(params)
+
+    return grid, newgrid
+
+# Ensemble version: independent replicas drawn at once (numpy generator)
+
+def init_ensemble(params):
+    shape = (params["n_replicas"], params["dx"], params["dy"])
+
+    params["rng"] = calipsolib.make_rng()
+    params["rng_replicas"] = calipsolib.make_block_rngs(params["n_replicas"])
+
+    grid = np.where(params["rng"].random(shape) < params["density"], TREE, EMPTY).astype(np.uint8)
+    grid[:, params["dx"] // 2, params["dy"] // 2] = FIRE
+    params["total_trees_start"] = np.count_nonzero(grid == TREE, axis=(1, 2))
+
+    return grid, np.empty_like(grid)
+
+# Out-of-core version: trees drawn tile by tile (numpy generator), no full grid in memory
+
+def init_mapped(params):
+    global mapped
+
+    if mapped is not None:
+        mapped.close()
+    params["rng"] = calipsolib.make_rng()
+    mapped = calipsolib.MappedGrids(params["memmap_path"], (params["dx"], params["dy"]), ca_step_tile)
+
+    if mapped.step > 0: # resumed from the file
+        params["iteration"] = mapped.step + 1
+        params["total_trees_start"] = mapped.meta["total_trees_start"]
+        return mapped.init_simulation(params)
+
+    grid, newgrid = mapped.init_simulation(params)
+    total = 0
+    for x0, x1 in mapped.tiles():
+        rows = np.where(params["rng"].random((x1 - x0, params["dy"])) < params["density"], TREE, EMPTY).astype(np.uint8)
+        total += int(np.count_nonzero(rows))
+        grid[x0:x1] = rows
+    grid[params["dx"] // 2, params["dy"] // 2] = FIRE
+    params["total_trees_start"] = total
+    mapped.meta["total_trees_start"] = total
+    mapped.flush()
 
     return grid, newgrid
 
 
 # Live simulation
 
-#@njit(cache=True)
-def ca_step(grid, newgrid):
-    global iteration, total_trees_start
-        
-    dx, dy = grid.shape
+# deterministic part of the rule, compiled from a rule table (also usable as a calipsolib.HashLife rule)
+
+rules = calipsolib.RuleTable(4, neighbourhood="moore")
+rules.add(ASH, EMPTY)
+rules.add(FIRE, ASH)
+rules.add(TREE, FIRE, when={FIRE: range(1, 9)})
+
+ca_step_deterministic = rules.compile()
+
+def ca_step_serial(grid, newgrid):
+    ca_step_deterministic(grid, newgrid)
+
+    # P_fire is the probability the tree burns
+    # P_tree is the probability that a new tree grows
+
+    if params["iteration"] > 70 and params["rare_events"] :
+        counts = ca_step_deterministic.counts # cells per state in newgrid, counted by the rule pass
+        np.put(newgrid, random_events.sample_cells(params["rng"], newgrid, TREE, params["P_fire"], counts[TREE]), FIRE)
+        np.put(newgrid, random_events.sample_cells(params["rng"], newgrid, EMPTY, params["P_tree"], counts[EMPTY]), TREE)
 
-    for x in range(dx):
-        for y in range(dy):
-            if grid[x, y] == ASH:
-                newgrid[x, y] = EMPTY
-            elif grid[x, y] == FIRE:
-                newgrid[x, y] = ASH
-            elif grid[x, y] == TREE:
-                if check_FIRE(grid, x, y, dx, dy):
-                    newgrid[x, y] = FIRE
+    elif params["iteration"] > 70 :
+        events = random_events.draw(params["rng"], grid.shape, {"fire": params["P_fire"], "tree": params["P_tree"]})
+        newgrid[(newgrid == TREE) & events["fire"]] = FIRE
+        newgrid[(newgrid == EMPTY) & events["tree"]] = TREE
+
+# Parallel version: each row block is updated by one thread with its own random stream
+
+@njit(parallel=True, cache=True)
+def ca_step_parallel(grid, newgrid, spontaneous, p_fire, p_tree, rng_blocks):
+    dx, dy = grid.shape
+    n_blocks = rng_blocks.shape[0]
+
+    for b in prange(n_blocks):
+        x0, x1 = calipsolib.block_rows(dx, b, n_blocks)
+        for x in range(x0, x1):
+            for y in range(dy):
+                if grid[x, y] == ASH:
+                    newgrid[x, y] = EMPTY
+                elif grid[x, y] == FIRE:
+                    newgrid[x, y] = ASH
+                elif grid[x, y] == TREE:
+                    if check_FIRE(grid, x, y, dx, dy):
+                        newgrid[x, y] = FIRE
+                    else:
+                        newgrid[x, y] = TREE
                 else:
-                    newgrid[x, y] = TREE
+                    newgrid[x, y] = EMPTY
+
+                if spontaneous :
+                    p1 = calipsolib.block_random(rng_blocks, b)
+                    p2 = calipsolib.block_random(rng_blocks, b)
+
+                    if p1 < p_fire :
+                        if newgrid[x,y] == TREE : newgrid[x,y] = FIRE
+
+                    if p2 < p_tree :
+                        if newgrid[x,y] == EMPTY : newgrid[x,y] = TREE
+
+# Multi-process and boundary versions: a tile padded with a one-cell halo (no modulo)
+
+@njit(cache=True)
+def ca_step_tile(tile, out, rng_state, args):
+    spontaneous, p_fire, p_tree = args[0] > 0, args[1], args[2]
+    nx, ny = out.shape
+
+    for x in range(nx):
+        for y in range(ny):
+            state = tile[x+1, y+1]
+            if state == ASH:
+                out[x, y] = EMPTY
+            elif state == FIRE:
+                out[x, y] = ASH
+            elif state == TREE:
+                out[x, y] = TREE
+                for i in range(3):
+                    for j in range(3):
+                        if tile[x+i, y+j] == FIRE:
+                            out[x, y] = FIRE
             else:
-                newgrid[x, y] = EMPTY
-            
-            # p1 is the probability the tree burns
-            # p2 is the probability that a new tree grows
-            
-            if iteration > 70 :
-                p1 = random.random()
-                p2 = random.random()
-            
-                if p1 < 0.002 :
-                    if newgrid[x,y] == TREE : newgrid[x,y] = FIRE
-            
-                if p2 < 0.006 : 
-                    if newgrid[x,y] == EMPTY : newgrid[x,y] = TREE
-                    
-    # Save updated tree fraction
-    
-    trees_fraction = np.sum(newgrid == TREE)/total_trees_start
-    with open("./TME01/trees.csv", "a", newline="") as f:
-        writer = csv.writer(f)
-        writer.writerow([iteration, trees_fraction])
-            
-    iteration += 1
+                out[x, y] = EMPTY
+
+            if spontaneous :
+                p1 = calipsolib.block_random(rng_state, 0)
+                p2 = calipsolib.block_random(rng_state, 0)
+
+                if p1 < p_fire :
+                    if out[x,y] == TREE : out[x,y] = FIRE
+
+                if p2 < p_tree :
+                    if out[x,y] == EMPTY : out[x,y] = TREE
+
+# Ensemble version: the tile kernel on each replica (periodic halo), one replica per thread,
+# each with its own random stream
+
+ensemble_tiles = None # padded copies of the replicas, reused every step
+
+def pad_replicas(grids):
+    global ensemble_tiles
+    n, dx, dy = grids.shape
+    if ensemble_tiles is None or ensemble_tiles.shape != (n, dx + 2, dy + 2):
+        ensemble_tiles = np.empty((n, dx + 2, dy + 2), dtype=grids.dtype)
+    tiles = ensemble_tiles
+    tiles[:, 1:-1, 1:-1] = grids
+    tiles[:, 0, 1:-1] = grids[:, -1]
+    tiles[:, -1, 1:-1] = grids[:, 0]
+    tiles[:, :, 0] = tiles[:, :, -2]
+    tiles[:, :, -1] = tiles[:, :, 1]
+    return tiles
+
+@njit(parallel=True, cache=True)
+def ca_step_ensemble(tiles, newgrids, rng_replicas, args):
+    for k in prange(newgrids.shape[0]):
+        ca_step_tile(tiles[k], newgrids[k], rng_replicas[k:k + 1], args)
+
+#@njit(cache=True)
+def ca_step(grid, newgrid):
+    if grid.ndim == 3:
+        args = np.array([params["iteration"] > 70, params["P_fire"], params["P_tree"]], dtype=np.float64)
+        ca_step_ensemble(pad_replicas(grid), newgrid, params["rng_replicas"], args)
+
+    elif params["processes"] > 0: # grid and newgrid are the shared buffers (init_simulation or resume_simulation)
+        tiled.ca_step(grid, newgrid, params["iteration"] > 70, params["P_fire"], params["P_tree"])
+        params["rng_tiles"][:] = tiled.rng_states
+
+    elif mapped is not None:
+        mapped.ca_step(grid, newgrid, params["iteration"] > 70, params["P_fire"], params["P_tree"])
+
+    elif params["boundary"] is not None: # checkpointed grids are copied into a padded scratch buffer
+        args = np.array([params["iteration"] > 70, params["P_fire"], params["P_tree"]], dtype=np.float64)
+        ca_step_tile(get_halo().refresh(grid), newgrid, params["rng_halo"], args)
+
+    elif params["parallel"]:
+        ca_step_parallel(grid, newgrid, params["iteration"] > 70, params["P_fire"], params["P_tree"], params["rng_blocks"])
+
+    else:
+        ca_step_serial(grid, newgrid)
+
+    params["iteration"] += 1
+
+# =-=-= observables (saved in TME01/trees.csv: step, trees, trees fraction)
+
+observables = calipsolib.Observables("./TME01/trees.csv")
+observables.grid_states({"trees": TREE})
+observables.add("trees_fraction", lambda grid, agents, values: values["trees"] / params["total_trees_start"])
 
 # =-=-= run
 
@@ -146,14 +347,17 @@ if __name__ == "__main__":
     calipsolib.run(
         params=params, # user-defined
         init_simulation=init_simulation, # user-defined
+        resume_simulation=resume_simulation, # user-defined
         ca_step=ca_step, # user-defined
         make_agents=make_agents, # user-defined
-        colors=colors,
+        colors_ca=colors,
+        colors_agents=None,
         dx=100, # CA width
         dy=100, # CA height
         display_dx=800,
         display_dy=800,
         title="Forest Fire CA", 
         verbose=True, # display stuff (can be used by user)
-        fps=60 # steps per seconds (default: 60)
+        fps=60, # steps per seconds (default: 60)
+        observables=observables,
     )
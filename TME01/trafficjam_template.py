@@ -4,7 +4,7 @@
 # Calipsomulator - a simple CA and Agent-based simulator
 # 2026, nb@su
 # 
-# GUI: curseur, z, shift+z, d, shift+d, reset, shift-reset
+# GUI: curseur, z, shift+z, d, shift+d, s (checkpoint), reset, shift-reset
 #
 
 import random
@@ -80,7 +80,8 @@ if __name__ == "__main__":
         init_simulation=init_simulation, # user-defined
         ca_step=ca_step, # user-defined
         make_agents=make_agents, # user-defined
-        colors=colors,
+        colors_ca=colors,
+        colors_agents=None,
         dx=80, # CA width
         dy=1, # CA height
         display_dx=800,
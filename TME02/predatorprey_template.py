@@ -4,18 +4,17 @@
 # Calipsomulator - a simple CA and Agent-based simulator
 # 2026, nb@su
 # 
-# GUI: curseur, z, shift+z, d, shift+d, reset, shift-reset
+# GUI: curseur, z, shift+z, d, shift+d, c (charts), s (checkpoint), reset, shift-reset
 #
 
 import random
 import numpy as np
-import csv
-import pygame
 
 try:
-    from numba import njit
+    from numba import njit, prange
 except ImportError:
     print ("[WARNING] Numba not available.")
+    prange = range
     def njit(*args, **kwargs):
         def wrapper(f):
             return f
@@ -41,7 +40,11 @@ params = {
     "len_agents" : 50,
     "prey_count" : 0,
     "predator_count" : 0,
-    "counted_this_iteration" : False
+    "counted_this_iteration" : False,
+    "rare_events" : True, # sample the few spontaneous trees/fires directly instead of one draw per cell
+    "parallel" : False, # multi-core ca_step (row blocks, one random stream per block)
+    "n_blocks" : 0, # number of row blocks, 0: one per numba thread
+    "synchronous_agents" : False # agents propose from the same snapshot, conflicts resolved by random priority
 }
 
 # =-=-= Defining cell types
@@ -62,14 +65,6 @@ colors_ca = {
     PREDATOR_TRAIL:  (255, 224, 224),
 }
 
-# Files Creation
-
-file = open ("./TME02/PREY_Count.csv", "w")
-file.close ()
-
-file = open ("./TME02/PREDATOR_Count.csv", "w")
-file.close ()
-
 # =-=-= Defining agent types
 
 PREY = 0
@@ -82,6 +77,22 @@ colors_agents = {
 
 # =-=-= user-defined agents
 
+MOVES = [(-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1)]
+
+# Count the number of Preys and Predators (once per iteration)
+def count_agents(agents):
+    if not params["counted_this_iteration"]:
+        params["prey_count"] = sum(1 for a in agents if a.type == PREY and a.running)
+        params["predator_count"] = sum(1 for a in agents if a.type == PREDATOR and a.running)
+        params["counted_this_iteration"] = True
+
+# running agent of the given type in a cell of the snapshot, or None
+def agent_at(cells, x, y, type):
+    for a in cells.get((x, y), ()):
+        if a.type == type and a.running:
+            return a
+    return None
+
 class Predator(Agent) :    
     def __init__(self, x, y, params):
         super().__init__(x, y, "Predator", params)
@@ -92,11 +103,7 @@ class Predator(Agent) :
 
     def move(self, grid, agents):
         
-        # Count the number of Preys and Predators
-        if not params["counted_this_iteration"]:
-            params["prey_count"] = sum(1 for a in agents if a.type == PREY and a.running)
-            params["predator_count"] = sum(1 for a in agents if a.type == PREDATOR and a.running)
-            params["counted_this_iteration"] = True
+        count_agents(agents)
     
         if not self.running :
             return
@@ -181,6 +188,54 @@ class Predator(Agent) :
                     agents.append(Predator(self.x, self.y, params))
                     params["len_agents"] += 1
 
+    # synchronous mode (params["synchronous_agents"]): same rules as move(), decided on the snapshot
+    # (only reads: the counts come from count_agents, run before the proposals).
+    # Claims the prey it eats: when two predators reach the same prey, only one of them eats it.
+    def propose(self, grid, agents, rng, cells):
+        delta_x, delta_y = rng.choice(MOVES)
+        x = (self.x + delta_x) % self.dx
+        y = (self.y + delta_y) % self.dy
+
+        # Follow an adjacent Prey
+        if self.trail :
+            for fx, fy in [(0, -1), (0, -2), (0, 1), (0, 2), (-1, 0), (-2, 0), (-1, 1), (-1, -1)] :
+                if agent_at(cells, (x + fx) % self.dx, (y + fy) % self.dy, PREY) is not None :
+                    x = (x + fx) % self.dx
+                    y = (y + fy) % self.dy
+                    break
+
+        prey = agent_at(cells, x, y, PREY)
+
+        reproduce = (params["iteration"] % (params["iteration_reproduce"]*2) == 0
+                     and rng.random() <= params["P_predator_alive"] and params["predator_count"] <= 20)
+
+        claims = [calipsolib.agent_claim(prey)] if prey is not None else []
+        return calipsolib.Proposal(*claims, x=x, y=y, prey=prey, reproduce=reproduce)
+
+    def apply(self, proposal, grid, agents, granted):
+        self.x, self.y = proposal.x, proposal.y
+
+        if self.trail and grid[self.x, self.y] not in [FIRE, ASH, TREE] :
+            grid[self.x, self.y] = PREDATOR_TRAIL
+
+        if granted and proposal.prey is not None and proposal.prey.running :
+            proposal.prey.running = False
+            proposal.prey.trail = False
+            self.hunger = 0
+        else :
+            self.hunger += 1
+
+        if self.hunger >= params["R_famine_predator"] :
+            self.running = False
+            self.trail = False
+            grid[self.x, self.y] = EMPTY
+            return None
+
+        if proposal.reproduce :
+            params["len_agents"] += 1
+            return [Predator(self.x, self.y, params)]
+        return None
+
 class Prey(Agent):
     
     def __init__(self, x, y, params):
@@ -192,11 +247,7 @@ class Prey(Agent):
 
     def move(self, grid, agents):
         
-        # Count the number of Preys and Predators
-        if not params["counted_this_iteration"]:
-            params["prey_count"] = sum(1 for a in agents if a.type == PREY and a.running)
-            params["predator_count"] = sum(1 for a in agents if a.type == PREDATOR and a.running)
-            params["counted_this_iteration"] = True
+        count_agents(agents)
             
         if not self.running :
             return
@@ -260,6 +311,53 @@ class Prey(Agent):
                     agents.append(Prey(self.x, self.y, params))
                     params["len_agents"] += 1
 
+    # synchronous mode: claims the cell it moves to, a Prey losing the cell to another one stays in place
+    def propose(self, grid, agents, rng, cells):
+        x, y = self.x, self.y
+        moved = rng.random() <= params["P_prey_movement"]
+        if moved :
+            delta_x, delta_y = rng.choice(MOVES)
+            x = (x + delta_x) % self.dx
+            y = (y + delta_y) % self.dy
+
+            # Escape an adjacent Predator
+            if self.trail :
+                for fx, fy in [(0, -1), (0, 1), (-1, 0), (1, 0)] :
+                    if agent_at(cells, (x + fx) % self.dx, (y + fy) % self.dy, PREDATOR) is not None :
+                        x = (x - fx) % self.dx
+                        y = (y - fy) % self.dy
+                        break
+
+        reproduce = (params["iteration"] % params["iteration_reproduce"] == 0
+                     and rng.random() <= params["P_prey_alive"] and params["prey_count"] <= 60)
+
+        claims = [calipsolib.cell_claim(x, y)] if moved else []
+        return calipsolib.Proposal(*claims, x=x, y=y, moved=moved, reproduce=reproduce)
+
+    def apply(self, proposal, grid, agents, granted):
+        if granted and proposal.moved :
+            self.x, self.y = proposal.x, proposal.y
+
+            if self.trail :
+                if grid[self.x, self.y] == TREE :
+                    self.hunger = 0
+                else :
+                    self.hunger += 1
+
+                if grid[self.x, self.y] not in [FIRE, ASH, PREDATOR_TRAIL] :
+                    grid[self.x, self.y] = PREY_TRAIL
+
+                if self.hunger >= params["R_famine_prey"] :
+                    self.running = False
+                    self.trail = False
+                    grid[self.x, self.y] = EMPTY
+                    return None
+
+        if proposal.reproduce :
+            params["len_agents"] += 1
+            return [Prey(self.x, self.y, params)]
+        return None
+
 # =-=-= make agents
 
 def make_agents(params):
@@ -276,6 +374,7 @@ def make_agents(params):
     return Agent_List
 
 # Check if a tree is adjacent to fire
+@njit(cache=True)
 def check_FIRE (grid, x, y, dx, dy) :
     if grid[(x-1)%dx, y] == FIRE : return True
 
@@ -297,6 +396,8 @@ def check_FIRE (grid, x, y, dx, dy) :
 
 # =-=-= user-defined cellular automata
 
+random_events = calipsolib.RandomEvents() # spontaneous trees and fires (serial ca_step)
+
 def init_simulation(params):
     dx = params["dx"]
     dy = params["dy"]
@@ -306,69 +407,111 @@ def init_simulation(params):
     
     grid[dx // 2, dy // 2] = FIRE
     
+    params["rng"] = calipsolib.make_rng()
+    
+    if params["parallel"] :
+        params["rng_blocks"] = calipsolib.make_block_rngs(params["n_blocks"])
+    
     return grid, newgrid
 
+# Parallel version: each row block is updated by one thread with its own random stream
+@njit(parallel=True, cache=True)
+def ca_step_parallel(grid, newgrid, p_tree, p_fire, clear_trails, rng_blocks):
+    dx, dy = grid.shape
+    n_blocks = rng_blocks.shape[0]
+
+    for b in prange(n_blocks):
+        x0, x1 = calipsolib.block_rows(dx, b, n_blocks)
+        for x in range(x0, x1):
+            for y in range(dy):
+
+                if grid[x,y] == PREDATOR_TRAIL :
+                    newgrid[x, y] = PREDATOR_TRAIL
+
+                elif grid[x,y] == PREY_TRAIL :
+                    newgrid[x, y] = PREY_TRAIL
+
+                # Trees simulation
+                elif grid[x, y] == TREE :
+                    if check_FIRE(grid, x, y, dx, dy) :
+                        newgrid[x, y] = FIRE
+                    else:
+                        newgrid[x, y] = TREE
+
+                elif grid[x, y] == FIRE :
+                    newgrid[x, y] = ASH
+
+                elif grid[x, y] == ASH :
+                    newgrid[x, y] = EMPTY
+
+                else:
+                    newgrid[x, y] = EMPTY
+
+                if newgrid[x,y] == EMPTY :
+
+                    # Produce a tree with a probability of 'P_tree'
+                    if calipsolib.block_random(rng_blocks, b) <= p_tree :
+                        newgrid[x,y] = TREE
+
+                    # Produce a fire with a probability of 'P_fire'
+                    elif calipsolib.block_random(rng_blocks, b) <= p_fire :
+                        newgrid[x,y] = FIRE
+
+                # Prevent the long trails
+                if clear_trails :
+                    if newgrid[x,y] == PREDATOR_TRAIL or newgrid[x,y] == PREY_TRAIL :
+                        newgrid[x,y] = EMPTY
+
+# next state without neighbours on fire (trails stay, fire -> ash -> empty)
+serial_lut = np.array([EMPTY, TREE, ASH, PREY_TRAIL, PREDATOR_TRAIL, EMPTY], dtype=np.uint8)
+
+fire_counts = None # neighbour counts buffer, reused every step
+
+def ca_step_serial(grid, newgrid):
+    global fire_counts
+
+    fire_counts = calipsolib.neighbour_counts(grid, (FIRE,), out=fire_counts)
+
+    np.take(serial_lut, grid, out=newgrid)
+    newgrid[(grid == TREE) & (fire_counts[0] > 0)] = FIRE
+
+    # Produce a tree with a probability of 'P_tree', or else a fire with a probability of 'P_fire'
+    if params["rare_events"] :
+        n_empty = np.count_nonzero(newgrid == EMPTY) # counted once, shared by both events
+        trees = random_events.sample_cells(params["rng"], newgrid, EMPTY, params["P_tree"], n_empty)
+        np.put(newgrid, trees, TREE)
+        np.put(newgrid, random_events.sample_cells(params["rng"], newgrid, EMPTY, params["P_fire"], n_empty - trees.size), FIRE)
+    else :
+        events = random_events.draw(params["rng"], grid.shape, {"tree": params["P_tree"], "fire": params["P_fire"]})
+        empty = newgrid == EMPTY
+        newgrid[empty & events["tree"]] = TREE
+        newgrid[empty & ~events["tree"] & events["fire"]] = FIRE
+
+    # Prevent the long trails
+    if params["iteration"]%params["iteration_trail"] == 0 :
+        newgrid[(newgrid == PREDATOR_TRAIL) | (newgrid == PREY_TRAIL)] = EMPTY
+
 # @njit(cache=True)
 def ca_step(grid, newgrid):
     global params
 
-    dx, dy = grid.shape
-    
-    pygame.display.set_caption(f"Population | Prey : {params['prey_count']} | Predators : {params['predator_count']}")
+    calipsolib.set_caption(f"Population | Prey : {params['prey_count']} | Predators : {params['predator_count']}")
     
     params["counted_this_iteration"] = False
 
-    for x in range(dx):
-        for y in range(dy):
-            
-            if grid[x,y] == PREDATOR_TRAIL :
-                newgrid[x, y] = PREDATOR_TRAIL
-                
-            elif grid[x,y] == PREY_TRAIL :
-                newgrid[x, y] = PREY_TRAIL
-            
-            # Trees simulation
-            elif grid[x, y] == TREE :
-                if check_FIRE(grid, x, y, dx, dy) :
-                    newgrid[x, y] = FIRE
-                else:
-                    newgrid[x, y] = TREE
-                    
-            elif grid[x, y] == FIRE :
-                newgrid[x, y] = ASH
-                    
-            elif grid[x, y] == ASH :
-                newgrid[x, y] = EMPTY
-                
-            else:
-                newgrid[x, y] = EMPTY
-                
-                
-            if newgrid[x,y] == EMPTY :
-            
-                # Produce a tree with a probability of 'P_tree'
-                if random.random() <= params["P_tree"] :
-                    newgrid[x,y] = TREE
-            
-                # Produce a fire with a probability of 'P_fire'
-                elif random.random() <= params["P_fire"] :
-                    newgrid[x,y] = FIRE
-            
-            # Prevent the long trails
-            if params["iteration"]%params["iteration_trail"] == 0 :
-                if newgrid[x,y] == PREDATOR_TRAIL or newgrid[x,y] == PREY_TRAIL :
-                    newgrid[x,y] = EMPTY
-                    
-    with open("./TME02/PREY_Count.csv", "a", newline="") as file :
-        writer = csv.writer(file)
-        writer.writerow([params["iteration"], params["prey_count"]])
-        
-    with open("./TME02/PREDATOR_Count.csv", "a", newline="") as file :
-        writer = csv.writer(file)
-        writer.writerow([params["iteration"], params["predator_count"]])
-    
+    if params["parallel"] :
+        clear_trails = params["iteration"]%params["iteration_trail"] == 0
+        ca_step_parallel(grid, newgrid, params["P_tree"], params["P_fire"], clear_trails, params["rng_blocks"])
+    else :
+        ca_step_serial(grid, newgrid)
+
     params["iteration"] += 1
 
+# =-=-= observables (saved in TME02/Population_Count.csv: step, prey, predator)
+
+observables = calipsolib.Observables("./TME02/Population_Count.csv")
+observables.agent_types({"prey": PREY, "predator": PREDATOR})
+
 # =-=-= run
 
 if __name__ == "__main__":
@@ -385,5 +528,11 @@ if __name__ == "__main__":
         display_dy=800,
         title="Predator-Prey (template)", 
         verbose=False, # display stuff (can be used by user)
-        fps=10 # steps per seconds (default: 60)
+        fps=10, # steps per seconds (default: 60)
+        charts={ # live population curves ("c" key)
+            "Prey": (lambda grid, agents: observables.last["prey"], colors_agents[PREY]),
+            "Predators": (lambda grid, agents: observables.last["predator"], colors_agents[PREDATOR]),
+        },
+        observables=observables,
+        agent_update=calipsolib.SynchronousUpdate(prepare=lambda grid, agents: count_agents(agents)) if params["synchronous_agents"] else None,
     )
@@ -4,12 +4,10 @@
 # Calipsomulator - a simple CA and Agent-based simulator
 # 2026, nb@su
 # 
-# GUI: curseur, z, shift+z, d, shift+d, reset, shift-reset
+# GUI: curseur, z, shift+z, d, shift+d, c (charts), s (checkpoint), reset, shift-reset
 #
 
 import random
-import csv
-import pygame
 import numpy as np
 
 try:
@@ -59,17 +57,6 @@ colors_agents = {
     RECOVER : (100, 100, 0),
 }
 
-# Files creation
-
-file = open("./TME03/SANE_Count.csv", "w")
-file.close()
-
-file = open("./TME03/INFECTED_Count.csv", "w")
-file.close()
-
-file = open("./TME03/RECOVER_Count.csv", "w")
-file.close()
-
 # =-=-= user-defined agents
 
 class Person(Agent):
@@ -166,7 +153,7 @@ def init_simulation(params):
 def ca_step(grid, newgrid):
     global params
 
-    pygame.display.set_caption(f"Sane : {params['sane_count']} | Infected : {params['infected_count']} | Recover : {params['recover_count']}")
+    calipsolib.set_caption(f"Sane : {params['sane_count']} | Infected : {params['infected_count']} | Recover : {params['recover_count']}")
 
     params["iteration_counted"] = False
 
@@ -175,21 +162,14 @@ def ca_step(grid, newgrid):
     for x in range (dx):
         for y in range (dy):
             newgrid[x, y] = grid[x, y]
-    
-    with open("./TME03/SANE_Count.csv", "a", newline="") as file :
-        writer = csv.writer(file)
-        writer.writerow([params["iteration"], params["sane_count"]])
-
-    with open("./TME03/INFECTED_Count.csv", "a", newline="") as file :
-        writer = csv.writer(file)
-        writer.writerow([params["iteration"], params["infected_count"]])
-
-    with open("./TME03/RECOVER_Count.csv", "a", newline="") as file :
-        writer = csv.writer(file)
-        writer.writerow([params["iteration"], params["recover_count"]])
 
     params["iteration"] += 1
     
+# =-=-= observables (saved in TME03/Population_Count.csv: step, sane, infected, recover)
+
+observables = calipsolib.Observables("./TME03/Population_Count.csv")
+observables.agent_types({"sane": SANE, "infected": INFECTED, "recover": RECOVER}, running_only=False)
+
 # =-=-= run
 
 if __name__ == "__main__":
@@ -206,5 +186,11 @@ if __name__ == "__main__":
         display_dy=800,
         title="Sane-Infected-Recover Model (template)", 
         verbose=False, # display stuff (can be used by user)
-        fps=10 # steps per seconds (default: 60)
+        fps=10, # steps per seconds (default: 60)
+        charts={ # live population curves ("c" key)
+            "Sane": (lambda grid, agents: observables.last["sane"], colors_agents[SANE]),
+            "Infected": (lambda grid, agents: observables.last["infected"], colors_agents[INFECTED]),
+            "Recover": (lambda grid, agents: observables.last["recover"], colors_agents[RECOVER]),
+        },
+        observables=observables,
     )
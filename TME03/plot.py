@@ -1,15 +1,13 @@
 import pandas as pd
 import matplotlib.pyplot as plt
 
-df1 = pd.read_csv("./TME03/SANE_Count.csv", header=None, names=["iteration", "count"])
-df2 = pd.read_csv("./TME03/INFECTED_Count.csv", header=None, names=["iteration", "count"])
-df3 = pd.read_csv("./TME03/RECOVER_Count.csv", header=None, names=["iteration", "count"])
+df = pd.read_csv("./TME03/Population_Count.csv", comment="#", header=None, names=["iteration", "sane", "infected", "recover"])
 
-iteration = df1["iteration"]
+iteration = df["iteration"]
 
-plt.plot(iteration, df1["count"], label="SANE")
-plt.plot(iteration, df2["count"], label="INFECTED")
-plt.plot(iteration, df3["count"], label="RECOVER")
+plt.plot(iteration, df["sane"], label="SANE")
+plt.plot(iteration, df["infected"], label="INFECTED")
+plt.plot(iteration, df["recover"], label="RECOVER")
 
 plt.xlabel("Iteration")
 plt.ylabel("Count")
@@ -12,9 +12,11 @@
 # Last revision: 2020-02-05
 
 import os
+import re
 import sys
 import datetime
 import time
+import warnings
 import numpy as np
 import matplotlib as mpl
 # mpl.use('TkAgg') # use matplotlib backend at PPTI (SU)
@@ -64,6 +66,101 @@ def parseLinesToArrayOfValues ( rawlines ):
             lines.append(l)
     return lines
 
+# fast loader: parses the whole file at once with numpy and returns only the requested columns
+# (one array per index). A binary sidecar (<filename>.cache.npy) is written and memory-mapped
+# on the next loads, as long as the csv file keeps the size and modification time recorded
+# with it (<sidecar>.stat).
+def loadColumnsFromFile( filename, indices, prefix = "", cache = True ):
+    global PngFileName
+
+    PngFileName = filename
+
+    sidecar = filename + ".cache.npy" if prefix == "" else filename + "." + prefix.encode().hex() + ".cache.npy"
+    stat = os.stat(filename)
+    source = "%d %d" % (stat.st_size, stat.st_mtime_ns)
+    if cache and os.path.exists(sidecar) and os.path.exists(sidecar + ".stat") and open(sidecar + ".stat").read() == source:
+        values = np.load(sidecar, mmap_mode="r")
+    else:
+        values = parseTextToArray( open(filename).read(), prefix, filename )
+        if cache:
+            try:
+                np.save(sidecar, values)
+                with open(sidecar + ".stat", "w") as f:
+                    f.write(source)
+            except OSError:
+                pass
+    return [ values[:, i] for i in indices ]
+
+# rows with missing values (e.g. the last line of a file cut off by a killed simulation) are padded with nan
+def parseTextToArray( text, prefix = "", filename = "" ):
+    if prefix != "" or "#" in text or re.search(r"\n\s*\n", text) is not None: # comments or blank lines
+        lines = text.split("\n")
+        if prefix != "":
+            lines = [ l[len(prefix):] for l in lines if l[0:len(prefix)] == prefix ]
+        text = "\n".join( l for l in lines if len(l.strip()) != 0 and l[0] != "#" )
+    text = text.strip()
+    if text == "":
+        return np.zeros((0, 0))
+    nbColumns = text[0:text.find("\n") if "\n" in text else len(text)].count(",") + 1
+    nbLines = text.count("\n") + 1
+    if text.count(",") == nbLines * (nbColumns - 1):
+        with warnings.catch_warnings(): # unparsable values: numpy stops early (deprecated) or raises
+            warnings.simplefilter("ignore", DeprecationWarning)
+            try:
+                values = np.fromstring(text.replace("\n", ","), sep=",")
+            except ValueError:
+                values = np.zeros(0)
+        if values.size == nbLines * nbColumns:
+            return values.reshape(-1, nbColumns)
+    return parseRaggedLines( text.split("\n"), filename )
+
+def parseRaggedLines( lines, filename = "" ):
+    rows = []
+    for i, l in enumerate(lines):
+        try:
+            rows.append([ float(v) if v.strip() != "" else np.nan for v in l.split(",") ])
+        except ValueError:
+            raise ValueError("%s: cannot parse data line %d: %r" % (filename or "csv text", i + 1, l)) from None
+    values = np.full((len(rows), max(len(r) for r in rows)), np.nan)
+    for i, r in enumerate(rows):
+        values[i, :len(r)] = r
+    return values
+
+# boxplot statistics for each column of Y (one row per file), computed with vectorized reductions.
+# returns one dict per column, as expected by Axes.bxp (whiskers at 1.5 IQR, like Axes.boxplot)
+def computeBoxplotStats( x, Y, whis = 1.5 ):
+    q1, med, q3 = np.percentile(Y, [25, 50, 75], axis=0)
+    iqr = q3 - q1
+    lo = q1 - whis * iqr
+    hi = q3 + whis * iqr
+    whislo = np.where(Y >= lo, Y, np.inf).min(axis=0)
+    whishi = np.where(Y <= hi, Y, -np.inf).max(axis=0)
+    outside = (Y < lo) | (Y > hi)
+    rows, cols = np.nonzero(outside.T) # sorted by column
+    fliers = np.split(Y.T[rows, cols], np.searchsorted(rows, np.arange(1, Y.shape[1])))
+    mean = Y.mean(axis=0)
+    return [ { "label": x[i], "med": med[i], "q1": q1[i], "q3": q3[i], "whislo": whislo[i], "whishi": whishi[i], "mean": mean[i], "fliers": fliers[i] } for i in range(Y.shape[1]) ]
+
+# shape-preserving downsampling: keep the min and max of each bucket (in index order), so
+# peaks and crashes survive. nbBuckets is typically the width of the axes in pixels.
+def decimateMinMax( x, y, nbBuckets ):
+    x = np.asarray(x)
+    y = np.asarray(y)
+    n = len(y)
+    if nbBuckets <= 0 or n <= 2 * nbBuckets:
+        return x, y
+    size = -(-n // nbBuckets) # points per bucket
+    m = (n // size) * size
+    offsets = np.arange(0, m, size)
+    blocks = y[:m].reshape(-1, size)
+    indices = [ offsets + blocks.argmin(axis=1), offsets + blocks.argmax(axis=1) ]
+    if m < n:
+        tail = y[m:]
+        indices.append( np.array([ m + tail.argmin(), m + tail.argmax() ]) )
+    indices.append( np.array([0, n - 1]) )
+    indices = np.unique( np.concatenate(indices) )
+    return x[indices], y[indices]
+
 def getTimestamp():
     return datetime.datetime.now().strftime("%Y%m%d_%H%M")
 
@@ -75,7 +172,7 @@ def getMaximumLength ( myList ): # return the length of maximally lengthy sub-el
 # many examples: http://matplotlib.org/gallery.html#
 # code below adapted from: http://blog.bharatbhole.com/creating-boxplots-with-matplotlib/
 # ###
-def traceData( x, y, type="single", title="", xLabel="", yLabel="", xlimMin=-1, xlimMax=-1, ylimMin=-1, ylimMax=-1, legendLabel="", locLegend='upper right', autoscaling=False, outputFilename="empty"):
+def traceData( x, y, type="single", title="", xLabel="", yLabel="", xlimMin=-1, xlimMax=-1, ylimMin=-1, ylimMax=-1, legendLabel="", locLegend='upper right', autoscaling=False, outputFilename="empty", decimation=True):
     global PngFileName
     
     #pl.gca().set_color_cycle(['red', 'green', 'blue', 'orange', 'violet', 'darkblue', 'black','purple','cyan','brown']) # force cycle through specified colors
@@ -88,9 +185,14 @@ def traceData( x, y, type="single", title="", xLabel="", yLabel="", xlimMin=-1,
 
     # plot data
     if type == "single":
+        if decimation == True: # about one min/max pair per horizontal pixel of the saved png (300 dpi)
+            x, y = decimateMinMax( x, y, int(ax.get_window_extent().width * 300 / fig.dpi) )
         ax.plot(x, y)
     elif type == "multi":
-        ax.boxplot(y)
+        if len(y) != 0 and isinstance(y[0], dict):
+            ax.bxp(y) # precomputed statistics (see computeBoxplotStats)
+        else:
+            ax.boxplot(y)
         ax.set_xticklabels(x)
     
     # Remove top axes and right axes ticks
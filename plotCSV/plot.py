@@ -14,6 +14,7 @@ import datetime
 import time
 import glob
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 
 from mylib import *
 
@@ -45,6 +46,12 @@ parser.add_argument('-locLegend', type=str, nargs='?', default='lower right', he
 
 parser.add_argument('--outputFilename', '-o', type=str, nargs='?', default=None, help='output graph filename [optional]')
 
+parser.add_argument('--noDecimation', action='store_true', help='plot every data point instead of the min/max of each pixel column [optional]')
+
+parser.add_argument('--verbose', '-v', action='store_true', help='print each data point [optional]')
+
+parser.add_argument('--noCache', action='store_true', help='do not read/write the binary cache file next to each input file [optional]')
+
 args = parser.parse_args()
 
 if debug == True:
@@ -59,38 +66,31 @@ if debug == True:
 
 # load file(s)
 
-rawlines = []
-lines = []
+def loadFile( filename ):
+    print(("Loading file:" + filename))
+    return loadColumnsFromFile( filename, [args.xIndex, args.yIndex], args.prefix, not args.noCache )
 
-for i in range (len(args.filenames)):
-    print(("Loading file:" + args.filenames[i]))
-    rawlines.append( getContentFromFile( args.filenames[i] ) )
-    rawlines[i] = getLinesWithPrefix ( rawlines[i], args.prefix, True)
-    lines.append( parseLinesToArrayOfValues( rawlines[i] ) )
+with ThreadPoolExecutor() as pool:
+    lines = list( pool.map( loadFile, args.filenames ) ) # one (x, y) pair of arrays per file
 
 if debug == True:
-    print(rawlines)
     print(lines)
 
 # display data
 
 if len(args.filenames) == 1:
     # display raw data from one single file
-    xData = []
-    yData = []
-    
-    i = 0
-    for l in lines[0]:
-        if i % args.resolution == 0:
-            xData.append( l[args.xIndex] )
-            yData.append( l[args.yIndex] )
-            print(( str(l[args.xIndex]) + "," + str(l[args.yIndex]) ))
-        i = i + 1
+    xData = lines[0][0][::args.resolution]
+    yData = lines[0][1][::args.resolution]
+
+    if args.verbose == True:
+        for x, y in zip(xData, yData):
+            print(( str(x) + "," + str(y) ))
     traceData( xData, yData, title=args.title, ylimMin=args.ylimMin, ylimMax=args.ylimMax,
               xlimMin=args.xlimMin, xlimMax=args.xlimMax,
               autoscaling=args.autoscaling, locLegend=args.locLegend, 
               xLabel=args.xLabel, yLabel=args.yLabel, 
-              outputFilename=args.outputFilename)
+              outputFilename=args.outputFilename, decimation=not args.noDecimation)
 else:
     # compile data from multiple files and display boxplots
     
@@ -101,20 +101,20 @@ else:
         print("[WARNING] at least 11 data file are recommended to trace boxplots. Continue.")
     
     for i in range (1,len(lines)):
-        if len(lines[0]) != len(lines[i]):
+        if len(lines[0][0]) != len(lines[i][0]):
             print("[ERROR] all data file must have the same amount of data. Stop.")
             quit()
 
-    xData = []
-    yData = []
-    
-    for i in range(0,len(lines[0]),args.resolution):
-        print(("i = " + str(i)))
-        xData.append( int(lines[0][i][args.xIndex]) )
-        l = []
-        for j in range(len(lines)):
-            l.append( lines[j][i][args.yIndex] )
-        yData.append(l)
-        print(( str(xData[-1]) + "," + str(yData[-1])))
-
-    traceData( xData, yData, "multi", title=args.title, ylimMin=args.ylimMin, ylimMax=args.ylimMax, xlimMin=args.xlimMin, xlimMax=args.xlimMax, autoscaling=args.autoscaling, locLegend=args.locLegend, xLabel=args.xLabel, yLabel=args.yLabel, outputFilename=args.outputFilename)
+    # one row per file, one column per x value
+    xData = lines[0][0][::args.resolution].astype(int)
+    yData = np.empty((len(lines), len(xData)))
+    for j in range(len(lines)):
+        yData[j] = lines[j][1][::args.resolution]
+
+    stats = computeBoxplotStats( xData, yData )
+
+    if args.verbose == True:
+        for s in stats:
+            print(( str(s["label"]) + ", median=" + str(s["med"]) + ", q1=" + str(s["q1"]) + ", q3=" + str(s["q3"]) ))
+
+    traceData( xData, stats, "multi", title=args.title, ylimMin=args.ylimMin, ylimMax=args.ylimMax, xlimMin=args.xlimMin, xlimMax=args.xlimMax, autoscaling=args.autoscaling, locLegend=args.locLegend, xLabel=args.xLabel, yLabel=args.yLabel, outputFilename=args.outputFilename)
@@ -0,0 +1,51 @@
+# regression tests for HashLife inside run(): records and checkpoint resume
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "TME03"))
+import calipsolib
+
+EMPTY, TREE, FIRE, ASH = 0, 1, 2, 3
+COLORS = {EMPTY: (0, 0, 0), TREE: (0, 255, 0), FIRE: (255, 0, 0), ASH: (64, 64, 64)}
+
+rules = calipsolib.RuleTable(4)
+rules.add(ASH, EMPTY)
+rules.add(FIRE, ASH)
+rules.add(TREE, FIRE, when={FIRE: range(1, 9)})
+forest_fire = rules.compile()
+
+def initial_grid(n=64):
+    grid = np.where(np.random.default_rng(0).random((n, n)) < 0.55, TREE, EMPTY).astype(np.uint8)
+    grid[n // 2, n // 2] = FIRE
+    return grid
+
+def direct(grid, steps):
+    a, b = grid.copy(), np.empty_like(grid)
+    for _ in range(steps):
+        forest_fire(a, b)
+        a, b = b, a
+    return a
+
+def run_engine(engine, **kwargs):
+    calipsolib.run(params={}, init_simulation=engine.init_simulation, ca_step=engine.ca_step,
+                   colors_ca=COLORS, colors_agents=None, dx=engine.shape[0], dy=engine.shape[1],
+                   headless=True, **kwargs)
+
+def test_record(tmp_path):
+    grid = initial_grid()
+    engine = calipsolib.HashLife(grid, forest_fire, steps_per_frame=2)
+    run_engine(engine, max_simulation_steps=10, record_path=str(tmp_path / "run.rec"), record_keyframe_every=4)
+    recording = calipsolib.Recording(str(tmp_path / "run.rec"))
+    recording.seek(len(recording) - 1)
+    assert np.array_equal(recording.grid, direct(grid, 20))
+
+def test_resume(tmp_path):
+    grid = initial_grid()
+    checkpoint = str(tmp_path / "run.npz")
+    run_engine(calipsolib.HashLife(grid, forest_fire, steps_per_frame=2), max_simulation_steps=6,
+               checkpoint_path=checkpoint, checkpoint_every=5)
+    engine = calipsolib.HashLife(np.zeros_like(grid), forest_fire, steps_per_frame=2)
+    run_engine(engine, max_simulation_steps=10, resume_from=checkpoint)
+    assert np.array_equal(engine.to_array(), direct(grid, 20))